@@ -1,45 +1,1476 @@
 import os
 import subprocess
-from flask import Flask, request, render_template, send_file, jsonify
+import json
+from flask import Flask, request, render_template, send_file, jsonify, Response, stream_with_context
 import yt_dlp
 import uuid
 from pathlib import Path
 import re
 import threading
 import time
+import hashlib
+import calendar
+import shutil
+import signal
+import socket
+import sqlite3
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Необязательные зависимости покадровой оптимизации GIF
+try:
+    import numpy as np
+    from PIL import Image, ImageSequence, GifImagePlugin
+except ImportError:
+    np = None
 
 app = Flask(__name__)
 
-TEMP_DIR = Path("temp")
-TEMP_DIR.mkdir(exist_ok=True)
+# Для нескольких узлов TEMP_DIR должен быть общим томом
+TEMP_DIR = Path(os.environ.get('VIDEOGIF_TEMP_DIR', 'temp'))
+TEMP_DIR.mkdir(parents=True, exist_ok=True)
 
 # Время жизни временных файлов в секундах (60 минут)
 TEMP_FILE_TTL = 60 * 60
 
-progress_store = {}
-lock = threading.Lock()
+# Промежуточные файлы (сегменты, окна пакетов, палитры) - отдельная область,
+# её можно вынести на tmpfs; готовые GIF/JPG остаются в TEMP_DIR
+SCRATCH_DIR = Path(os.environ.get('VIDEOGIF_SCRATCH_DIR', str(TEMP_DIR / 'scratch')))
+# Жёсткий лимит байт файлов задач в обеих областях (без кэша результатов)
+STORAGE_QUOTA_BYTES = int(os.environ.get('VIDEOGIF_STORAGE_BYTES', 2 * 1024 * 1024 * 1024))
+# Минимум свободного места на томе области; меньше - сразу вытесняются старые файлы
+STORAGE_MIN_FREE_BYTES = int(os.environ.get('VIDEOGIF_MIN_FREE_BYTES', 512 * 1024 * 1024))
+# Как часто проверять TTL и свободное место в фоне, секунды
+STORAGE_SWEEP_INTERVAL = 60
 
-def cleanup_old_files():
-    """Удаление устаревших временных файлов"""
-    current_time = time.time()
-    for file_path in TEMP_DIR.glob("*"):
-        if file_path.is_file():
-            file_age = current_time - file_path.stat().st_mtime
-            if file_age > TEMP_FILE_TTL:
+# Передача файлов результатов фронт-прокси вместо потока Python:
+# '' - отдаёт Flask; 'x-accel' - nginx (X-Accel-Redirect); 'x-sendfile' - Apache/lighttpd
+RESULT_OFFLOAD = os.environ.get('VIDEOGIF_RESULT_OFFLOAD', '')
+# internal-location nginx, указывающая на TEMP_DIR
+RESULT_ACCEL_PREFIX = os.environ.get('VIDEOGIF_ACCEL_PREFIX', '/protected-results/')
+# Результат задачи не меняется, поэтому CDN и браузер могут хранить его до удаления файлов
+RESULT_MAX_AGE = int(os.environ.get('VIDEOGIF_RESULT_MAX_AGE', TEMP_FILE_TTL))
+
+# Пул обработчиков: по одному на ядро процессора
+JOB_WORKERS = int(os.environ.get('VIDEOGIF_WORKERS', os.cpu_count() or 2))
+# Максимальная глубина очереди; при переполнении /convert отвечает 503
+MAX_QUEUE_DEPTH = int(os.environ.get('VIDEOGIF_MAX_QUEUE', 50))
+# Отдельные лимиты для стадии скачивания (сеть) и кодирования (CPU)
+DOWNLOAD_CONCURRENCY = int(os.environ.get('VIDEOGIF_DOWNLOAD_SLOTS', JOB_WORKERS))
+ENCODE_CONCURRENCY = int(os.environ.get('VIDEOGIF_ENCODE_SLOTS', max(1, JOB_WORKERS // 2)))
+# Пакетная конвертация: максимум клипов в запросе; диапазоны, между которыми
+# меньше BATCH_MERGE_GAP секунд, скачиваются одним окном
+MAX_BATCH_CLIPS = int(os.environ.get('VIDEOGIF_BATCH_CLIPS', 20))
+BATCH_MERGE_GAP = int(os.environ.get('VIDEOGIF_BATCH_MERGE_GAP', 10))
+# Предельное время стадий в секундах (без ожидания слота); по истечении процессы задачи останавливаются
+STAGE_DEADLINES = {
+    'download': int(os.environ.get('VIDEOGIF_DOWNLOAD_TIMEOUT', 180)),
+    'encode': int(os.environ.get('VIDEOGIF_ENCODE_TIMEOUT', 300)),
+}
+# Потоковое кодирование одновременно скачивает и кодирует
+STAGE_DEADLINES['stream'] = STAGE_DEADLINES['download'] + STAGE_DEADLINES['encode']
+# Таймаут сетевых операций yt-dlp: зависшее соединение освобождает обработчик не позже этого срока
+YTDLP_SOCKET_TIMEOUT = int(os.environ.get('VIDEOGIF_SOCKET_TIMEOUT', 20))
+
+# Параметры кодирования GIF (входят в ключ кэша результатов)
+GIF_VIDEO_FILTER = 'fps=20,scale=640:-1:flags=lanczos'
+GIF_PALETTEGEN = 'palettegen=stats_mode=diff:max_colors=256'
+GIF_PALETTEUSE = 'paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle'
+# Профили кодирования: ширина и fps (не выше, чем у источника), алгоритм масштабирования
+# и дизеринг GIF. 'standard' совпадает с параметрами GIF_* выше
+ENCODE_PROFILES = {
+    'high': {'width': 800, 'fps': 25, 'scaler': 'lanczos', 'dither': 'sierra2_4a'},
+    'standard': {'width': 640, 'fps': 20, 'scaler': 'lanczos', 'dither': 'bayer:bayer_scale=5'},
+    'balanced': {'width': 480, 'fps': 15, 'scaler': 'bicubic', 'dither': 'bayer:bayer_scale=3'},
+    'fast': {'width': 320, 'fps': 10, 'scaler': 'bilinear', 'dither': 'none'},
+}
+# Профиль по умолчанию: имя из ENCODE_PROFILES или 'auto' - standard с поправкой на
+# источник и понижением до balanced/fast под нагрузкой
+ENCODE_PROFILE = os.environ.get('VIDEOGIF_ENCODE_PROFILE', 'auto')
+# Пороги нагрузки для auto: задач (в работе и в очереди) на обработчик или load average на ядро
+LOAD_DEGRADE_STEPS = ((2.0, 'fast'), (1.25, 'balanced'))
+# Выходные форматы: расширение файла и Content-Type для /download
+OUTPUT_FORMATS = {
+    'gif': {'ext': '.gif', 'mimetype': 'image/gif'},
+    'webp': {'ext': '.webp', 'mimetype': 'image/webp'},
+    'mp4': {'ext': '.mp4', 'mimetype': 'video/mp4'},
+    'avif': {'ext': '.avif', 'mimetype': 'image/avif'},
+}
+DEFAULT_OUTPUT = {'format': 'gif', 'target_size': None, 'quality': None, 'profile': ENCODE_PROFILE}
+# Ступени (ширина, fps) для подбора под целевой размер файла; первая - параметры по умолчанию
+ENCODE_LADDER = [(640, 20), (560, 15), (480, 15), (400, 12), (320, 10), (240, 8)]
+# Грубая оценка байт на пиксель кадра для выбора стартовой ступени
+BYTES_PER_PIXEL = {'gif': 0.2, 'webp': 0.03, 'mp4': 0.008, 'avif': 0.005}
+# Сколько раз перекодировать со ступенью ниже, если результат больше целевого размера
+MAX_ENCODE_ATTEMPTS = 3
+
+# Режим кодирования: 'single' - один запуск ffmpeg с общим декодированием,
+# 'two_pass' - прежние отдельные запуски для палитры, GIF и превью
+GIF_ENCODE_MODE = os.environ.get('VIDEOGIF_ENCODE_MODE', 'single')
+# Потоковый режим: ffmpeg читает нужный диапазон прямо из источника, без промежуточного MP4.
+# Работает только с режимом 'single' (одно декодирование)
+STREAMING_ENABLED = os.environ.get('VIDEOGIF_STREAMING', '1') == '1'
+
+# Покадровая оптимизация готового GIF (нужны numpy и Pillow): удаление повторяющихся
+# кадров, обрезка до изменившейся области, прозрачность неизменившихся пикселей.
+# Включается явно; настройки входят в ключ кэша результатов
+GIF_OPTIMIZE = os.environ.get('VIDEOGIF_GIF_OPTIMIZE', '0') == '1'
+# Бюджет времени оптимизации на задачу, секунды; не уложились - остаётся исходный GIF
+GIF_OPTIMIZE_BUDGET = float(os.environ.get('VIDEOGIF_OPTIMIZE_BUDGET', 3.0))
+# Пиксель считается неизменившимся, если каналы отличаются не больше чем на столько
+GIF_FRAME_TOLERANCE = int(os.environ.get('VIDEOGIF_FRAME_TOLERANCE', 6))
+# Кадр с меньшей долей изменившихся пикселей считается повтором предыдущего
+GIF_DUPLICATE_RATIO = 0.001
+# Протоколы yt-dlp, которые ffmpeg умеет читать напрямую
+STREAMABLE_PROTOCOLS = {'http', 'https', 'm3u8', 'm3u8_native'}
+
+# Скачивание сегмента: 'keyframe' - от ближайшего предшествующего ключевого кадра
+# до конца клипа (индекс ключевых кадров через ffprobe или список фрагментов HLS/DASH),
+# 'padded' - прежний фиксированный запас -2/+4 с
+SEEK_MODE = os.environ.get('VIDEOGIF_SEEK_MODE', 'keyframe')
+# Насколько раньше начала клипа ffprobe ищет ключевой кадр, сек
+KEYFRAME_LOOKBEHIND = 10
+# Запас после конца клипа при скачивании от ключевого кадра (переупорядоченные B-кадры), сек
+KEYFRAME_TAIL = 1
+PROBE_TIMEOUT = 20
+
+# Кэш результатов yt-dlp extract_info: срок жизни и число записей
+METADATA_CACHE_TTL = int(os.environ.get('VIDEOGIF_METADATA_TTL', 30 * 60))
+METADATA_CACHE_SIZE = int(os.environ.get('VIDEOGIF_METADATA_ENTRIES', 256))
+
+# Кэш готовых результатов: бюджет в байтах с вытеснением давно не использованных
+CACHE_DIR = TEMP_DIR / "cache"
+RESULT_CACHE_BYTES = int(os.environ.get('VIDEOGIF_CACHE_BYTES', 512 * 1024 * 1024))
+
+# Интервал пустых комментариев в SSE-потоке, чтобы прокси не закрывали соединение
+SSE_HEARTBEAT = 15
+
+# Хранилище состояния задач: 'memory' (один процесс) или 'sqlite:///path/to/state.db'
+STATE_BACKEND_URL = os.environ.get('VIDEOGIF_STATE_BACKEND', 'memory')
+# Аренда задачи: если владелец не продлил её за это время, задача перезапускается другим обработчиком
+LEASE_TTL = int(os.environ.get('VIDEOGIF_LEASE_TTL', 60))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class MemoryStateBackend:
+    """Состояние задач в памяти процесса (по умолчанию, один процесс)"""
+    
+    def __init__(self):
+        self._tasks = {}
+        self._updated = {}
+        self._jobs = {}
+        self._changed = threading.Condition()
+        self._generation = 0
+    
+    def _notify(self):
+        self._generation += 1
+        self._changed.notify_all()
+    
+    def get(self, task_id):
+        with self._changed:
+            state = self._tasks.get(task_id)
+            return dict(state) if state is not None else None
+    
+    def put(self, task_id, state):
+        with self._changed:
+            previous = self._tasks.get(task_id) or {}
+            state = dict(state, version=previous.get('version', 0) + 1)
+            self._tasks[task_id] = state
+            self._updated[task_id] = time.time()
+            self._notify()
+    
+    def update(self, task_id, changes):
+        """Частичное обновление; None удаляет поле. Возвращает True, если состояние изменилось"""
+        with self._changed:
+            state = self._tasks.get(task_id)
+            if state is None or not apply_changes(state, changes):
+                return False
+            state['version'] = state.get('version', 0) + 1
+            self._updated[task_id] = time.time()
+            self._notify()
+            return True
+    
+    def delete(self, task_id):
+        with self._changed:
+            self._jobs.pop(task_id, None)
+            self._updated.pop(task_id, None)
+            if self._tasks.pop(task_id, None) is not None:
+                self._notify()
+    
+    def generation(self):
+        with self._changed:
+            return self._generation
+    
+    def wait(self, generation, timeout):
+        """Ожидание любого изменения после generation. False - истёк timeout"""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._generation != generation, timeout=timeout)
+    
+    def add_job(self, task_id, payload, owner, lease_ttl):
+        with self._changed:
+            self._jobs[task_id] = {'payload': payload, 'owner': owner, 'lease_expires': time.time() + lease_ttl}
+    
+    def renew_leases(self, task_ids, owner, lease_ttl):
+        with self._changed:
+            for task_id in task_ids:
+                job = self._jobs.get(task_id)
+                if job is not None and job['owner'] == owner:
+                    job['lease_expires'] = time.time() + lease_ttl
+    
+    def finish_job(self, task_id):
+        with self._changed:
+            self._jobs.pop(task_id, None)
+    
+    def claim_expired_job(self, owner, lease_ttl):
+        """Захват задачи с истёкшей арендой. Возвращает (task_id, payload) или None"""
+        now = time.time()
+        with self._changed:
+            for task_id, job in self._jobs.items():
+                if job['lease_expires'] < now:
+                    job['owner'] = owner
+                    job['lease_expires'] = now + lease_ttl
+                    return task_id, job['payload']
+        return None
+    
+    def purge(self, max_age):
+        """Удаление состояний задач, не менявшихся дольше max_age секунд"""
+        deadline = time.time() - max_age
+        with self._changed:
+            for task_id in [task_id for task_id, updated in self._updated.items() if updated < deadline]:
+                self._tasks.pop(task_id, None)
+                self._updated.pop(task_id, None)
+                self._jobs.pop(task_id, None)
+
+class SQLiteStateBackend:
+    """Общее состояние задач в SQLite (WAL) для нескольких процессов gunicorn на одном узле
+    или нескольких узлов с общим томом.
+    
+    Аренда задач (lease) продлевается владельцем; если процесс упал, аренда
+    истекает и задачу забирает другой обработчик.
+    """
+    
+    # Как часто ожидающие SSE-потоки проверяют изменения из других процессов
+    POLL_INTERVAL = 0.25
+    
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self._changed = threading.Condition()
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                task_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                lease_expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+        """)
+    
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('PRAGMA busy_timeout=30000')
+            self._local.db = db
+        return db
+    
+    def _write(self, func):
+        """Выполнение func(db) в транзакции записи с увеличением счётчика изменений"""
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            changed = func(db)
+            if changed:
+                db.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        if changed:
+            with self._changed:
+                self._changed.notify_all()
+        return changed
+    
+    def get(self, task_id):
+        row = self._db().execute('SELECT state, version FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(json.loads(row[0]), version=row[1])
+    
+    def put(self, task_id, state):
+        def write(db):
+            row = db.execute('SELECT version FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            version = row[0] + 1 if row else 1
+            db.execute(
+                'INSERT OR REPLACE INTO tasks (task_id, state, version, updated) VALUES (?, ?, ?, ?)',
+                (task_id, json.dumps(state, ensure_ascii=False), version, time.time())
+            )
+            return True
+        self._write(write)
+    
+    def update(self, task_id, changes):
+        def write(db):
+            row = db.execute('SELECT state, version FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                return False
+            state = json.loads(row[0])
+            if not apply_changes(state, changes):
+                return False
+            db.execute(
+                'UPDATE tasks SET state = ?, version = ?, updated = ? WHERE task_id = ?',
+                (json.dumps(state, ensure_ascii=False), row[1] + 1, time.time(), task_id)
+            )
+            return True
+        return self._write(write)
+    
+    def delete(self, task_id):
+        def write(db):
+            db.execute('DELETE FROM jobs WHERE task_id = ?', (task_id,))
+            return db.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,)).rowcount > 0
+        self._write(write)
+    
+    def generation(self):
+        return self._db().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+    
+    def wait(self, generation, timeout):
+        deadline = time.time() + timeout
+        while self.generation() == generation:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            # Изменения из этого процесса будят сразу, из других - через опрос
+            with self._changed:
+                self._changed.wait(min(self.POLL_INTERVAL, remaining))
+        return True
+    
+    def add_job(self, task_id, payload, owner, lease_ttl):
+        def write(db):
+            db.execute(
+                'INSERT OR REPLACE INTO jobs (task_id, payload, owner, lease_expires) VALUES (?, ?, ?, ?)',
+                (task_id, json.dumps(payload, ensure_ascii=False), owner, time.time() + lease_ttl)
+            )
+            return False
+        self._write(write)
+    
+    def renew_leases(self, task_ids, owner, lease_ttl):
+        if not task_ids:
+            return
+        def write(db):
+            db.executemany(
+                'UPDATE jobs SET lease_expires = ? WHERE task_id = ? AND owner = ?',
+                [(time.time() + lease_ttl, task_id, owner) for task_id in task_ids]
+            )
+            return False
+        self._write(write)
+    
+    def finish_job(self, task_id):
+        def write(db):
+            db.execute('DELETE FROM jobs WHERE task_id = ?', (task_id,))
+            return False
+        self._write(write)
+    
+    def claim_expired_job(self, owner, lease_ttl):
+        claimed = []
+        def write(db):
+            now = time.time()
+            row = db.execute(
+                'SELECT task_id, payload FROM jobs WHERE lease_expires < ? ORDER BY lease_expires LIMIT 1', (now,)
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    'UPDATE jobs SET owner = ?, lease_expires = ? WHERE task_id = ?',
+                    (owner, now + lease_ttl, row[0])
+                )
+                claimed.append((row[0], json.loads(row[1])))
+            return False
+        self._write(write)
+        return claimed[0] if claimed else None
+    
+    def purge(self, max_age):
+        def write(db):
+            deadline = time.time() - max_age
+            db.execute('DELETE FROM jobs WHERE task_id IN (SELECT task_id FROM tasks WHERE updated < ?)', (deadline,))
+            return db.execute('DELETE FROM tasks WHERE updated < ?', (deadline,)).rowcount > 0
+        self._write(write)
+
+def apply_changes(state, changes):
+    """Применение изменений к словарю состояния (None удаляет поле). Возвращает True при изменении"""
+    changed = False
+    for key, value in changes.items():
+        if value is None:
+            if key in state:
+                del state[key]
+                changed = True
+        elif state.get(key) != value:
+            state[key] = value
+            changed = True
+    return changed
+
+def create_state_backend(url):
+    """Хранилище состояния по URL: 'memory' или 'sqlite:///path/to/state.db' (абсолютный путь /path/to/state.db)"""
+    if url == 'memory':
+        return MemoryStateBackend()
+    parts = urlsplit(url)
+    if parts.scheme == 'sqlite' and not parts.netloc and parts.path.startswith('/'):
+        return SQLiteStateBackend(parts.path)
+    raise ValueError(f'Неизвестное хранилище состояния: {url}')
+
+task_store = create_state_backend(STATE_BACKEND_URL)
+
+download_slots = threading.BoundedSemaphore(DOWNLOAD_CONCURRENCY)
+encode_slots = threading.BoundedSemaphore(ENCODE_CONCURRENCY)
+
+class JobQueue:
+    """FIFO-очередь задач с ограниченной глубиной"""
+    
+    def __init__(self, max_depth):
+        self.max_depth = max_depth
+        self._jobs = deque()
+        self._cond = threading.Condition()
+        self.active = 0
+    
+    def submit(self, task_id, func, *args):
+        """Ставит задачу в очередь. Возвращает позицию (1 - следующая) или None, если очередь заполнена"""
+        with self._cond:
+            if len(self._jobs) >= self.max_depth:
+                return None
+            self._jobs.append((task_id, func, args))
+            self._cond.notify()
+            return len(self._jobs)
+    
+    def get(self):
+        """Блокирующее получение следующей задачи"""
+        with self._cond:
+            while not self._jobs:
+                self._cond.wait()
+            self.active += 1
+            return self._jobs.popleft()
+    
+    def done(self):
+        with self._cond:
+            self.active -= 1
+    
+    def position(self, task_id):
+        """Позиция задачи в очереди или None, если она уже выполняется"""
+        with self._cond:
+            for position, job in enumerate(self._jobs, 1):
+                if job[0] == task_id:
+                    return position
+        return None
+    
+    def remove(self, task_id):
+        """Удаление ещё не начатой задачи из очереди"""
+        with self._cond:
+            for job in self._jobs:
+                if job[0] == task_id:
+                    self._jobs.remove(job)
+                    return True
+        return False
+    
+    def __len__(self):
+        with self._cond:
+            return len(self._jobs)
+
+job_queue = JobQueue(MAX_QUEUE_DEPTH)
+
+# Параметры запроса, не влияющие на содержимое видео
+TRACKING_PARAMS = {'fbclid', 'gclid', 'yclid', 'si', 'feature', 'ref'}
+
+def normalize_video_url(url):
+    """Приведение URL к каноническому виду для ключа кэша"""
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith('utm_') and key.lower() not in TRACKING_PARAMS
+    )
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path.rstrip('/'), urlencode(query), ''))
+
+class ResultCache:
+    """Content-addressed кэш готовых GIF/JPG с LRU-вытеснением по бюджету в байтах"""
+    
+    RESULT_EXTENSIONS = tuple(spec['ext'] for spec in OUTPUT_FORMATS.values()) + ('.jpg',)
+    PRIMARY_EXTENSIONS = tuple(spec['ext'] for spec in OUTPUT_FORMATS.values())
+    # Пустой файл-отметка последнего использования: mtime самих результатов не меняется,
+    # иначе меняются ETag и Last-Modified отдаваемых файлов (они жёсткие ссылки на кэш)
+    USED_SUFFIX = '.used'
+    
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.directory.mkdir(exist_ok=True)
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._aliases = {}
+        self._lock = threading.Lock()
+        self._load()
+    
+    def _load(self):
+        """Восстановление индекса из файлов кэша, старые записи - в начале LRU"""
+        entries = {}
+        used_marks = {}
+        for file_path in self.directory.glob("*"):
+            if file_path.suffix == self.USED_SUFFIX:
+                used_marks[file_path.stem] = file_path.stat().st_mtime
+            elif file_path.suffix in self.RESULT_EXTENSIONS:
+                stat = file_path.stat()
+                entry = entries.setdefault(file_path.stem, {'files': {}, 'size': 0, 'used': 0})
+                entry['files'][file_path.suffix] = file_path
+                entry['size'] += stat.st_size
+                entry['used'] = max(entry['used'], stat.st_mtime)
+        for key, used in used_marks.items():
+            if key in entries:
+                entries[key]['used'] = max(entries[key]['used'], used)
+            else:
+                (self.directory / f"{key}{self.USED_SUFFIX}").unlink(missing_ok=True)
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]['used']):
+            if any(suffix in entry['files'] for suffix in self.PRIMARY_EXTENSIONS):
+                self._entries[key] = entry
+                self.total_bytes += entry['size']
+        self._evict()
+    
+    def remember_source(self, video_url, info):
+        """Привязка URL к id видео из yt-dlp, чтобы разные ссылки на одно видео давали один ключ"""
+        if info and info.get('id') and info.get('extractor_key'):
+            with self._lock:
+                self._aliases[normalize_video_url(video_url)] = f"{info['extractor_key']}:{info['id']}"
+    
+    def key_for(self, video_url, start_time, duration, output=None):
+        """Ключ кэша: источник, временное окно и параметры кодирования"""
+        output = output or DEFAULT_OUTPUT
+        normalized = normalize_video_url(video_url)
+        with self._lock:
+            source = self._aliases.get(normalized, normalized)
+        raw = '|'.join([
+            source, str(start_time), str(duration), GIF_VIDEO_FILTER, GIF_PALETTEGEN, GIF_PALETTEUSE,
+            output['format'], str(output.get('target_size')), str(output.get('quality')), str(output.get('profile')),
+            gif_optimizer_signature() if output['format'] == 'gif' else '',
+        ])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def restore(self, key, unique_id, recheck=False):
+        """Копирует результат из кэша в файлы задачи. Возвращает True при попадании.
+        
+        recheck - повторная проверка той же задачи (по ключу канонической ссылки
+        после извлечения): её промах уже посчитан первым поиском, а попадание
+        заменяет этот промах.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                try:
+                    for suffix, cached_path in entry['files'].items():
+                        link_or_copy(cached_path, TEMP_DIR / f"{unique_id}{suffix}")
+                    self._mark_used(key)
+                except OSError as e:
+                    print(f"Ошибка чтения кэша {key}: {e}")
+                    self._drop(key)
+                    entry = None
+            if entry is None:
+                if not recheck:
+                    self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if recheck and self.misses:
+                self.misses -= 1
+            return True
+    
+    def store(self, key, unique_id):
+        """Сохраняет результаты задачи в кэш"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            entry = {'files': {}, 'size': 0}
+            try:
+                for suffix in self.RESULT_EXTENSIONS:
+                    source_path = TEMP_DIR / f"{unique_id}{suffix}"
+                    if source_path.exists():
+                        cached_path = self.directory / f"{key}{suffix}"
+                        link_or_copy(source_path, cached_path)
+                        entry['files'][suffix] = cached_path
+                        entry['size'] += cached_path.stat().st_size
+            except OSError as e:
+                print(f"Ошибка записи в кэш {key}: {e}")
+                for cached_path in entry['files'].values():
+                    cached_path.unlink(missing_ok=True)
+                return
+            if not any(suffix in entry['files'] for suffix in self.PRIMARY_EXTENSIONS):
+                return
+            self._entries[key] = entry
+            self.total_bytes += entry['size']
+            self._mark_used(key)
+            self._evict()
+    
+    def _mark_used(self, key):
+        (self.directory / f"{key}{self.USED_SUFFIX}").touch()
+    
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry['size']
+        for cached_path in entry['files'].values():
+            cached_path.unlink(missing_ok=True)
+        (self.directory / f"{key}{self.USED_SUFFIX}").unlink(missing_ok=True)
+    
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._drop(key)
+            self.evictions += 1
+            print(f"Вытеснен из кэша: {key}")
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+def link_or_copy(source_path, target_path):
+    """Жёсткая ссылка вместо копирования; копия, если ссылки не поддерживаются"""
+    target_path.unlink(missing_ok=True)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copy2(source_path, target_path)
+
+result_cache = ResultCache(CACHE_DIR, RESULT_CACHE_BYTES)
+
+class StorageFull(OSError):
+    """Лимит хранилища превышен файлами задач, которые сейчас обрабатываются"""
+
+class StorageManager:
+    """Файлы задач в двух областях: scratch (промежуточные) и results (GIF/JPG).
+    
+    Размеры файлов учитываются в памяти, поэтому учёт и вытеснение не обходят
+    каталоги. При каждой записи (track) проверяются лимит байт и свободное место
+    на томе области; при нехватке удаляются все файлы давно не использованных
+    задач (LRU). Файлы задач в обработке (pin) не вытесняются.
+    
+    Учёт ведётся в пределах процесса: при нескольких процессах с общим TEMP_DIR
+    каждый учитывает и вытесняет только созданные им файлы, лимит действует на
+    процесс. Файлы других процессов и оставшиеся после сбоя удаляются обходом
+    каталогов раз в TTL - по mtime старше TTL (touch обновляет файл-отметку {id}.used).
+    """
+    
+    # Имена файлов задач начинаются с uuid задачи
+    OWNER_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+    
+    def __init__(self, areas, quota_bytes, min_free_bytes, on_evict=None):
+        self.areas = areas
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._entries = OrderedDict()  # owner -> {'files': {path: (area, size)}, 'used': ts}
+        self._bytes = {area: 0 for area in areas}
+        self._pinned = {}
+        self._orphans_swept = None
+        self._lock = threading.Lock()
+        for directory in areas.values():
+            directory.mkdir(parents=True, exist_ok=True)
+    
+    def _owner(self, path):
+        match = self.OWNER_PATTERN.match(path.name)
+        return match.group(0) if match else None
+    
+    def _area_of(self, path):
+        for area, directory in self.areas.items():
+            if path.parent == directory:
+                return area
+        return None
+    
+    def _sweep_orphans(self, expire_before):
+        """Удаление чужих и оставшихся после сбоя задач, все файлы которых старше expire_before.
+        
+        Возраст задачи - самый свежий mtime её файлов, включая отметку использования (touch).
+        """
+        owners = {}
+        for directory in self.areas.values():
+            for path in directory.iterdir():
+                owner = self._owner(path)
+                if owner is None:
+                    continue
                 try:
-                    file_path.unlink()
-                    print(f"Удален устаревший файл: {file_path}")
-                except Exception as e:
-                    print(f"Ошибка при удалении файла {file_path}: {e}")
+                    if not path.is_file():
+                        continue
+                    mtime = path.stat().st_mtime
+                except OSError:
+                    continue
+                files, used = owners.get(owner, ([], 0))
+                owners[owner] = (files + [path], max(used, mtime))
+        removed = set()
+        for owner, (files, used) in owners.items():
+            if used >= expire_before:
+                continue
+            with self._lock:
+                if owner in self._entries or owner in self._pinned:
+                    continue
+            for path in files:
+                path.unlink(missing_ok=True)
+            removed.add(owner)
+        return removed
+    
+    def _forget_file(self, owner, path):
+        entry = self._entries.get(owner)
+        if entry is None or path not in entry['files']:
+            return
+        area, size = entry['files'].pop(path)
+        self._bytes[area] -= size
+        if not entry['files']:
+            del self._entries[owner]
+    
+    def _drop_owner(self, owner):
+        """Удаление всех файлов задачи из обеих областей"""
+        entry = self._entries.pop(owner, None)
+        if entry is not None:
+            for area, size in entry['files'].values():
+                self._bytes[area] -= size
+        for directory in self.areas.values():
+            for path in directory.glob(f"{owner}*"):
+                path.unlink(missing_ok=True)
+    
+    def _free_bytes(self, area):
+        try:
+            return shutil.disk_usage(self.areas[area]).free
+        except OSError:
+            return self.min_free_bytes
+    
+    def _evict_lru(self, area=None):
+        """Вытеснение самой давно использованной незакреплённой задачи (с файлами в area)"""
+        for owner, entry in self._entries.items():
+            if owner in self._pinned:
+                continue
+            if area is not None and all(file_area != area for file_area, _ in entry['files'].values()):
+                continue
+            self._drop_owner(owner)
+            self.evictions += 1
+            return owner
+        return None
+    
+    def _enforce(self):
+        """Вытеснение до соблюдения лимита и порога свободного места; возвращает вытесненные задачи"""
+        evicted = []
+        while sum(self._bytes.values()) > self.quota_bytes:
+            owner = self._evict_lru()
+            if owner is None:
+                break
+            evicted.append(owner)
+        for area in self.areas:
+            while self._free_bytes(area) < self.min_free_bytes:
+                owner = self._evict_lru(area)
+                if owner is None:
+                    break
+                evicted.append(owner)
+        return evicted
+    
+    def _notify(self, evicted):
+        for owner in evicted:
+            print(f"Файлы задачи {owner} вытеснены: превышен лимит хранилища")
+            if self.on_evict is not None:
+                self.on_evict(owner)
+    
+    def path(self, area, name):
+        return self.areas[area] / name
+    
+    def track(self, *paths):
+        """Учёт записанных файлов с вытеснением старых при нехватке места.
+        
+        Если лимит превышен файлами задач в обработке, задача, записавшая файлы,
+        получает StorageFull; файлы остальных задач просто вытесняются.
+        """
+        owners = set()
+        with self._lock:
+            for path in paths:
+                owner, area = self._owner(path), self._area_of(path)
+                if owner is None or area is None or not path.exists():
+                    continue
+                self._forget_file(owner, path)
+                size = path.stat().st_size
+                entry = self._entries.setdefault(owner, {'files': {}, 'used': time.time()})
+                entry['files'][path] = (area, size)
+                entry['used'] = time.time()
+                self._entries.move_to_end(owner)
+                self._bytes[area] += size
+                owners.add(owner)
+            evicted = self._enforce()
+            over_quota = sum(self._bytes.values()) > self.quota_bytes
+            writer_pinned = any(owner in self._pinned for owner in owners)
+        self._notify(evicted)
+        if over_quota and writer_pinned:
+            raise StorageFull(f'Превышен лимит хранилища {self.quota_bytes} байт')
+    
+    def touch(self, owner):
+        """Отметка использования (скачивание результата) для LRU и обхода других процессов.
+        
+        Другие процессы видят её по mtime файла-отметки: mtime отдаваемых
+        результатов не меняется, от него зависят ETag и Last-Modified.
+        """
+        with self._lock:
+            entry = self._entries.get(owner)
+            if entry is not None:
+                entry['used'] = time.time()
+                self._entries.move_to_end(owner)
+        try:
+            (self.areas['results'] / f"{owner}{ResultCache.USED_SUFFIX}").touch()
+        except OSError:
+            pass
+    
+    def discard(self, path):
+        """Удаление промежуточного файла"""
+        path = Path(path)
+        with self._lock:
+            owner = self._owner(path)
+            if owner is not None:
+                self._forget_file(owner, path)
+        path.unlink(missing_ok=True)
+    
+    def remove_task(self, owner):
+        with self._lock:
+            self._drop_owner(owner)
+    
+    def pin(self, owner):
+        with self._lock:
+            self._pinned[owner] = self._pinned.get(owner, 0) + 1
+    
+    def unpin(self, owner):
+        with self._lock:
+            count = self._pinned.pop(owner, 0) - 1
+            if count > 0:
+                self._pinned[owner] = count
+    
+    def sweep(self, ttl):
+        """Фоновая очистка: файлы задач старше ttl, файлы, удалённые другими процессами,
+        проверка свободного места и раз в ttl - обход каталогов"""
+        now = time.time()
+        expire_before = now - ttl
+        with self._lock:
+            expired = [
+                owner for owner, entry in self._entries.items()
+                if entry['used'] < expire_before and owner not in self._pinned
+            ]
+            for owner in expired:
+                self._drop_owner(owner)
+            # Файлы могли удалить /cleanup и вытеснение другого процесса
+            for owner, entry in list(self._entries.items()):
+                for path in [path for path in entry['files'] if not path.exists()]:
+                    self._forget_file(owner, path)
+            evicted = self._enforce()
+        if self._orphans_swept is None or now - self._orphans_swept >= ttl:
+            self._orphans_swept = now
+            expired.extend(self._sweep_orphans(expire_before))
+        for owner in expired:
+            print(f"Удалены устаревшие файлы задачи {owner}")
+        self._notify(evicted)
+    
+    def total_bytes(self):
+        with self._lock:
+            return sum(self._bytes.values())
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'bytes': dict(self._bytes),
+                'tasks': len(self._entries),
+                'pinned': len(self._pinned),
+                'evictions': self.evictions,
+                'quota_bytes': self.quota_bytes,
+                'free_bytes': {area: self._free_bytes(area) for area in self.areas},
+            }
+
+def result_evicted(task_id):
+    """Результат задачи удалён из-за нехватки места - клиент узнаёт об этом из состояния"""
+    task_store.update(task_id, {
+        'progress': 0,
+        'status': 'Результат удалён: закончилось место на сервере',
+        'error': True,
+        'evicted': True
+    })
+
+storage = StorageManager({'scratch': SCRATCH_DIR, 'results': TEMP_DIR},
+                         STORAGE_QUOTA_BYTES, STORAGE_MIN_FREE_BYTES, result_evicted)
+
+class InflightJobs:
+    """Одинаковые конвертации в работе: повторный запрос присоединяется к идущей задаче.
+    
+    Ключ - ключ кэша результатов. У конвертации есть ведущая задача (та, что
+    выполняется) и присоединённые; присоединённые видят прогресс ведущей, а по
+    завершении получают жёсткие ссылки на её файлы. Каждый запрос держит ссылку
+    на конвертацию: очистка ведущей задачи, пока к ней кто-то присоединён,
+    откладывается до завершения, а конвертация без ссылок останавливается.
+    Учёт ведётся в пределах процесса.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}  # key -> {'task_id', 'followers', 'released'}
+        self._keys = {}  # task_id (ведущей или присоединённой) -> key
+    
+    def attach(self, key, task_id):
+        """Регистрация запроса: id ведущей задачи или None, если task_id сам становится ведущим"""
+        with self._lock:
+            job = self._jobs.get(key)
+            self._keys[task_id] = key
+            if job is None:
+                self._jobs[key] = {'task_id': task_id, 'followers': set(), 'released': False}
+                return None
+            job['followers'].add(task_id)
+            return job['task_id']
+    
+    def release(self, task_id):
+        """Отказ запроса от конвертации: список задач, чьи файлы и состояние можно удалить"""
+        with self._lock:
+            key = self._keys.get(task_id)
+            if key is None:
+                return [task_id]
+            job = self._jobs[key]
+            if job['task_id'] == task_id:
+                # Ключ ведущей задачи нужен finish(), пока к ней кто-то присоединён
+                job['released'] = True
+                removable = []
+            else:
+                job['followers'].discard(task_id)
+                del self._keys[task_id]
+                removable = [task_id]
+            if job['released'] and not job['followers']:
+                del self._jobs[key]
+                self._keys.pop(job['task_id'], None)
+                removable.append(job['task_id'])
+            return removable
+    
+    def finish(self, task_id):
+        """Завершение ведущей задачи: (присоединённые задачи, отказался ли её запрос)"""
+        with self._lock:
+            key = self._keys.get(task_id)
+            job = self._jobs.get(key)
+            if job is None or job['task_id'] != task_id:
+                return [], False
+            del self._jobs[key]
+            for follower in job['followers']:
+                self._keys.pop(follower, None)
+            self._keys.pop(task_id, None)
+            return sorted(job['followers']), job['released']
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+inflight_jobs = InflightJobs()
+
+def share_results(task_id):
+    """Раздача результата ведущей задачи присоединённым: ссылки на файлы и итоговое состояние"""
+    followers, released = inflight_jobs.finish(task_id)
+    if not followers and not released:
+        return
+    
+    state = get_task_state(task_id)
+    succeeded = find_result(task_id)[0] is not None
+    for follower in followers:
+        if succeeded:
+            for suffix in ResultCache.RESULT_EXTENSIONS:
+                source_path = TEMP_DIR / f"{task_id}{suffix}"
+                if source_path.exists():
+                    link_or_copy(source_path, TEMP_DIR / f"{follower}{suffix}")
+                    storage.track(TEMP_DIR / f"{follower}{suffix}")
+            final = state or {'progress': 100, 'status': 'Готово! GIF и изображение созданы', 'download_percent': 100}
+        elif state is not None and state.get('error'):
+            final = state
+        else:
+            final = {'progress': 0, 'status': 'Ошибка обработки', 'download_percent': 0, 'error': True}
+        final = {field: value for field, value in final.items() if field not in ('version', 'attached_to')}
+        set_task_state(follower, dict(final, shared_with=task_id))
+    
+    if released:
+        # Запрос ведущей задачи уже выполнил /cleanup - её файлы больше никому не нужны
+        cleanup_task_files(task_id)
+
+# Задачи этого процесса (в очереди и в работе), аренду которых нужно продлевать
+owned_jobs = set()
+owned_jobs_lock = threading.Lock()
+
+def enqueue_conversion(unique_id, video_url, start_time, duration, vk_username=None, vk_password=None, output=None):
+    """Постановка задачи в очередь и регистрация в общем хранилище.
+    
+    Данные VK в хранилище не попадают: после перезапуска на другом обработчике
+    такая задача снова запросит авторизацию.
+    """
+    position = job_queue.submit(
+        unique_id, process_video_task,
+        video_url, start_time, duration, vk_username, vk_password, output
+    )
+    if position is None:
+        return None
+    with owned_jobs_lock:
+        owned_jobs.add(unique_id)
+    task_store.add_job(unique_id, {
+        'video_url': video_url,
+        'start_time': start_time,
+        'duration': duration,
+        'output': output,
+    }, WORKER_ID, LEASE_TTL)
+    return position
+
+def enqueue_batch(batch_id, video_url, clips, output=None):
+    """Постановка пакета клипов в очередь одной задачей"""
+    position = job_queue.submit(batch_id, process_batch_task, video_url, clips, output)
+    if position is None:
+        return None
+    with owned_jobs_lock:
+        owned_jobs.add(batch_id)
+    task_store.add_job(batch_id, {
+        'video_url': video_url,
+        'clips': clips,
+        'output': output,
+    }, WORKER_ID, LEASE_TTL)
+    return position
+
+def batch_state(clips, output, status='В очереди...'):
+    """Начальное состояние пакета; клипы - список {gif_id, start_time, duration}"""
+    return {
+        'batch': True,
+        'clips': clips,
+        'progress': 0,
+        'status': status,
+        'download_percent': 0,
+        'output_format': (output or DEFAULT_OUTPUT)['format'],
+        'queued': True,
+        'queued_at': time.time()
+    }
+
+def job_worker():
+    """Обработчик из пула: последовательно выполняет задачи из очереди"""
+    while True:
+        task_id, func, args = job_queue.get()
+        try:
+            state = get_task_state(task_id)
+            # Задачу этой очереди отменили или очистили через другой процесс
+            if state is None or state.get('cancel_requested'):
+                if state is not None:
+                    set_task_state(task_id, cancelled_state('Отменено пользователем'))
+                continue
+            if state.get('queued_at'):
+                record_span(task_id, 'queue', time.time() - state['queued_at'])
+            task_store.update(task_id, {'queued': None, 'queued_at': None})
+            func(task_id, *args)
+        except Exception as e:
+            print(f"Ошибка обработчика для задачи {task_id}: {e}")
+        finally:
+            task_store.finish_job(task_id)
+            with owned_jobs_lock:
+                owned_jobs.discard(task_id)
+            job_queue.done()
+
+def lease_keeper():
+    """Продление аренды своих задач и перезапуск задач упавших обработчиков"""
+    while True:
+        time.sleep(LEASE_TTL / 3)
+        try:
+            with owned_jobs_lock:
+                task_ids = list(owned_jobs)
+            task_store.renew_leases(task_ids, WORKER_ID, LEASE_TTL)
+            
+            while len(job_queue) < job_queue.max_depth:
+                claimed = task_store.claim_expired_job(WORKER_ID, LEASE_TTL)
+                if claimed is None:
+                    break
+                task_id, payload = claimed
+                print(f"Перезапуск задачи {task_id} после сбоя обработчика")
+                if payload.get('clips') is not None:
+                    batch = get_task_state(task_id) or {}
+                    set_task_state(task_id, batch_state(
+                        batch.get('clips', []), payload.get('output'), 'Перезапуск после сбоя обработчика...'
+                    ))
+                    if enqueue_batch(task_id, payload['video_url'], payload['clips'], payload.get('output')) is None:
+                        break
+                    continue
+                task_store.put(task_id, {
+                    'progress': 0,
+                    'status': 'Перезапуск после сбоя обработчика...',
+                    'download_percent': 0,
+                    'queued': True,
+                    'queued_at': time.time()
+                })
+                if enqueue_conversion(task_id, payload['video_url'], payload['start_time'], payload['duration'],
+                                      output=payload.get('output')) is None:
+                    break
+        except Exception as e:
+            print(f"Ошибка продления аренды задач: {e}")
+
+def cleanup_old_files():
+    """Удаление устаревших временных файлов задач.
+    
+    Кэш результатов (TEMP_DIR/cache) сюда не попадает: его размер ограничен
+    бюджетом RESULT_CACHE_BYTES и вытеснением в ResultCache.
+    """
+    task_store.purge(TEMP_FILE_TTL)
+    storage.sweep(TEMP_FILE_TTL)
 
 def update_progress(task_id, progress, status, download_percent=None):
-    """Thread-safe progress update"""
-    with lock:
-        if task_id in progress_store:
-            progress_store[task_id]['progress'] = progress
-            progress_store[task_id]['status'] = status
-            if download_percent is not None:
-                progress_store[task_id]['download_percent'] = download_percent
+    """Thread-safe progress update; подписчики уведомляются только при реальном изменении"""
+    changes = {'progress': round(progress, 1), 'status': status}
+    if download_percent is not None:
+        changes['download_percent'] = download_percent
+    task_store.update(task_id, changes)
+
+def set_task_state(task_id, state):
+    """Полная замена состояния задачи с уведомлением подписчиков"""
+    task_store.put(task_id, state)
+
+def get_task_state(task_id):
+    """Копия состояния задачи или None"""
+    return task_store.get(task_id)
+
+def drop_task(task_id):
+    """Удаление состояния задачи"""
+    task_store.delete(task_id)
+
+def task_snapshot(task_id):
+    """Состояние задачи для клиента: с позицией в очереди и ссылками на результат"""
+    state = get_task_state(task_id)
+    if state is None:
+        return None
+    if state.get('attached_to'):
+        shared = task_snapshot(state['attached_to'])
+        if shared is not None:
+            # Файлы присоединённой задачи появятся после раздачи результата ведущей
+            shared.pop('gif_url', None)
+            shared.pop('image_url', None)
+            if shared.get('progress', 0) >= 100 and not shared.get('error'):
+                shared['progress'] = 99
+                shared['status'] = 'Подготовка результата...'
+            return dict(shared, attached_to=state['attached_to'], version=state.get('version', 0) + shared.get('version', 0))
+        return state
+    if state.get('queued'):
+        position = job_queue.position(task_id)
+        if position is not None:
+            state['queue_position'] = position
+            state['status'] = f'В очереди: позиция {position}'
+    if state.get('progress', 0) >= 100 and not state.get('error'):
+        state['gif_url'] = f'/download/{task_id}'
+        state['image_url'] = f'/download_image/{task_id}'
+    return state
+
+class Metrics:
+    """Метрики процесса в текстовом формате Prometheus"""
+    
+    # Границы корзин гистограммы длительности стадий, секунды
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._cpu_seconds = {}
+        self._errors = {}
+        self._downloaded_bytes = 0
+        self._output_bytes = 0
+        self._optimize_saved_bytes = 0
+    
+    def observe_stage(self, stage, seconds, cpu_seconds=0.0, bytes_downloaded=None, output_bytes=None):
+        with self._lock:
+            histogram = self._durations.setdefault(stage, {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            self._cpu_seconds[stage] = self._cpu_seconds.get(stage, 0.0) + cpu_seconds
+            self._downloaded_bytes += bytes_downloaded or 0
+            self._output_bytes += output_bytes or 0
+    
+    def count_error(self, kind):
+        with self._lock:
+            self._errors[kind] = self._errors.get(kind, 0) + 1
+    
+    def count_optimized(self, saved_bytes):
+        with self._lock:
+            self._optimize_saved_bytes += saved_bytes
+    
+    def render(self, gauges):
+        """Текст для /metrics; gauges - текущие значения {имя: (описание, значение)}"""
+        lines = [
+            '# HELP videogif_stage_duration_seconds Wall time of each processing stage',
+            '# TYPE videogif_stage_duration_seconds histogram',
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self._durations.items()):
+                for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                    lines.append(f'videogif_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'videogif_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'videogif_stage_duration_seconds_sum{{stage="{stage}"}} {histogram["sum"]:.6f}')
+                lines.append(f'videogif_stage_duration_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+            
+            lines.append('# HELP videogif_stage_cpu_seconds_total CPU time (user + sys) of ffmpeg child processes per stage')
+            lines.append('# TYPE videogif_stage_cpu_seconds_total counter')
+            for stage, seconds in sorted(self._cpu_seconds.items()):
+                lines.append(f'videogif_stage_cpu_seconds_total{{stage="{stage}"}} {seconds:.6f}')
+            
+            lines.append('# HELP videogif_errors_total Failed tasks by failure kind')
+            lines.append('# TYPE videogif_errors_total counter')
+            for kind, count in sorted(self._errors.items()):
+                lines.append(f'videogif_errors_total{{kind="{kind}"}} {count}')
+            
+            lines.append('# HELP videogif_downloaded_bytes_total Bytes of source video fetched to disk')
+            lines.append('# TYPE videogif_downloaded_bytes_total counter')
+            lines.append(f'videogif_downloaded_bytes_total {self._downloaded_bytes}')
+            lines.append('# HELP videogif_output_bytes_total Bytes of produced GIF and preview files')
+            lines.append('# TYPE videogif_output_bytes_total counter')
+            lines.append(f'videogif_output_bytes_total {self._output_bytes}')
+            lines.append('# HELP videogif_optimize_saved_bytes_total Bytes removed from GIFs by the frame optimizer')
+            lines.append('# TYPE videogif_optimize_saved_bytes_total counter')
+            lines.append(f'videogif_optimize_saved_bytes_total {self._optimize_saved_bytes}')
+        
+        for name, (description, value) in gauges.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def record_span(task_id, stage, seconds, cpu_seconds=0.0, bytes_downloaded=None, output_bytes=None):
+    """Запись стадии в метрики и в состояние задачи (поля spans и timings)"""
+    metrics.observe_stage(stage, seconds, cpu_seconds, bytes_downloaded, output_bytes)
+    state = get_task_state(task_id)
+    if state is None:
+        return
+    span = {'stage': stage, 'wall_seconds': round(seconds, 3), 'cpu_seconds': round(cpu_seconds, 3)}
+    if bytes_downloaded is not None:
+        span['bytes_downloaded'] = bytes_downloaded
+    if output_bytes is not None:
+        span['output_bytes'] = output_bytes
+    timings = dict(state.get('timings') or {})
+    timings[stage] = round(seconds, 3)
+    task_store.update(task_id, {'spans': (state.get('spans') or []) + [span], 'timings': timings})
+
+class StageSpan:
+    """Замер стадии задачи: wall time, CPU дочерних ffmpeg, скачанные и выходные байты"""
+    
+    def __init__(self, task_id, stage):
+        self.task_id = task_id
+        self.stage = stage
+        self.cpu_seconds = 0.0
+        self.bytes_downloaded = None
+        self.output_bytes = None
+    
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        record_span(
+            self.task_id, self.stage, time.perf_counter() - self._started,
+            self.cpu_seconds, self.bytes_downloaded, self.output_bytes
+        )
+        return False
+
+class TaskCancelled(BaseException):
+    """Задача отменена через /cancel или превысила срок стадии.
+    
+    Как asyncio.CancelledError, наследуется от BaseException: обработчики
+    except Exception внутри стадий не превращают отмену в обычную ошибку.
+    """
+    
+    def __init__(self, reason, stage=None):
+        super().__init__(reason, stage)
+        self.reason = reason
+        self.stage = stage
+    
+    @property
+    def status(self):
+        if self.reason == 'timeout':
+            return f'Превышено время стадии: {self.stage}'
+        return 'Отменено пользователем'
+
+class Supervisor:
+    """Надзор за процессами задач: сроки стадий и отмена.
+    
+    ffmpeg запускается в собственной группе процессов, поэтому остановка убивает
+    всё дерево. Один поток (run) раз в секунду проверяет сроки стадий и отмены,
+    запрошенные другими процессами через общее хранилище (поле cancel_requested
+    или удалённое состояние). yt-dlp работает внутри процесса: его останавливает
+    progress-хук (check), а зависшие соединения ограничены socket_timeout. ffmpeg,
+    который yt-dlp запускает для download_ranges, не останавливается: отмена и срок
+    стадии срабатывают после его завершения, зависшее чтение ограничено rw_timeout.
+    """
+    
+    # Сколько хранится отметка об отмене задачи, которая так и не запустилась
+    STALE_AFTER = 10 * 60
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks = {}  # task_id -> {'stage', 'deadline', 'processes', 'reason', 'since'}
+    
+    def _entry(self, task_id):
+        entry = self._tasks.get(task_id)
+        if entry is None:
+            entry = self._tasks[task_id] = {
+                'stage': None, 'deadline': None, 'processes': set(), 'reason': None, 'since': time.monotonic()
+            }
+        return entry
+    
+    @staticmethod
+    def _kill(processes):
+        for process in processes:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+    
+    @contextmanager
+    def stage(self, task_id, stage):
+        """Стадия со сроком STAGE_DEADLINES[stage]; отмена проверяется на входе и на выходе"""
+        with self._lock:
+            entry = self._entry(task_id)
+            entry['stage'] = stage
+            entry['deadline'] = time.monotonic() + STAGE_DEADLINES[stage]
+        self.check(task_id)
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry['deadline'] = None
+        self.check(task_id)
+    
+    def attach(self, task_id, process):
+        with self._lock:
+            entry = self._entry(task_id)
+            entry['processes'].add(process)
+            if entry['reason']:
+                self._kill([process])
+    
+    def detach(self, task_id, process):
+        with self._lock:
+            entry = self._tasks.get(task_id)
+            if entry is not None:
+                entry['processes'].discard(process)
+    
+    def cancelled(self, task_id):
+        with self._lock:
+            entry = self._tasks.get(task_id)
+            return entry is not None and entry['reason'] is not None
+    
+    def check(self, task_id):
+        """TaskCancelled, если задача отменена или стадия просрочена"""
+        with self._lock:
+            entry = self._tasks.get(task_id)
+            if entry is not None and entry['reason']:
+                raise TaskCancelled(entry['reason'], entry['stage'])
+    
+    def cancel(self, task_id):
+        """Отмена задачи: её процессы убиваются сразу, код задачи получит TaskCancelled"""
+        with self._lock:
+            entry = self._entry(task_id)
+            if entry['reason'] is None:
+                entry['reason'] = 'cancelled'
+                entry['since'] = time.monotonic()
+            self._kill(list(entry['processes']))
+    
+    def forget(self, task_id):
+        with self._lock:
+            self._tasks.pop(task_id, None)
+    
+    def poll_requests(self):
+        """Отмена задач этого процесса, запрошенная через общее хранилище состояния"""
+        with self._lock:
+            task_ids = [
+                task_id for task_id, entry in self._tasks.items()
+                if entry['reason'] is None and entry['stage'] is not None
+            ]
+        for task_id in task_ids:
+            state = task_store.get(task_id)
+            if state is None or state.get('cancel_requested'):
+                print(f"Задача {task_id}: отмена запрошена другим процессом")
+                self.cancel(task_id)
+    
+    def run(self):
+        """Поток-надзиратель: остановка задач с истёкшим сроком стадии или отменённых извне"""
+        while True:
+            time.sleep(1)
+            try:
+                self.poll_requests()
+            except Exception as e:
+                print(f"Ошибка проверки отмен: {e}")
+            now = time.monotonic()
+            with self._lock:
+                for task_id, entry in list(self._tasks.items()):
+                    if entry['reason'] is None and entry['deadline'] is not None and entry['deadline'] < now:
+                        print(f"Задача {task_id}: превышено время стадии {entry['stage']}")
+                        entry['reason'] = 'timeout'
+                        entry['since'] = now
+                        self._kill(list(entry['processes']))
+                    elif (entry['reason'] and entry['deadline'] is None and not entry['processes']
+                          and now - entry['since'] > self.STALE_AFTER):
+                        del self._tasks[task_id]
+
+supervisor = Supervisor()
+
+def run_ffmpeg(cmd, span=None, on_line=None):
+    """Запуск ffmpeg с построчным чтением stderr. Возвращает (код возврата, хвост stderr).
+    
+    CPU-время дочернего процесса (rusage из wait4) добавляется к span. Процесс
+    работает под надзором supervisor (по задаче span); если его остановили,
+    вместо кода возврата выбрасывается TaskCancelled.
+    """
+    task_id = span.task_id if span is not None else None
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        bufsize=1,
+        start_new_session=True
+    )
+    supervisor.attach(task_id, process)
+    try:
+        stderr_tail = deque(maxlen=20)
+        for line in process.stderr:
+            stderr_tail.append(line)
+            if on_line is not None:
+                on_line(line)
+        process.stderr.close()
+        
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if span is not None:
+                span.cpu_seconds += usage.ru_utime + usage.ru_stime
+        else:
+            process.wait()
+    finally:
+        supervisor.detach(task_id, process)
+    supervisor.check(task_id)
+    return process.returncode, ''.join(stderr_tail)
+
+def temp_dir_bytes():
+    """Суммарный размер файлов задач и кэша результатов (по индексам, без обхода каталогов)"""
+    return storage.total_bytes() + result_cache.stats()['bytes']
+
+def output_size(*paths):
+    return sum(path.stat().st_size for path in paths if path.exists())
 
 def is_direct_video_url(url):
     """Проверка, является ли URL прямой ссылкой на видео файл"""
@@ -52,6 +1483,8 @@ def is_vk_video(url):
 
 def progress_hook(d, task_id):
     """Хук для отслеживания прогресса скачивания"""
+    if supervisor.cancelled(task_id):
+        raise yt_dlp.utils.DownloadCancelled('Задача отменена')
     if d['status'] == 'downloading':
         if 'total_bytes' in d:
             download_progress = (d['downloaded_bytes'] / d['total_bytes']) * 100
@@ -103,23 +1536,66 @@ def convert_video():
         if not video_url:
             return jsonify({'error': 'Указаны не все параметры'}), 400
         
+        output, output_error = parse_output_options(data)
+        if output_error:
+            return jsonify({'error': output_error}), 400
+        
         unique_id = str(uuid.uuid4())
+        cache_key = result_cache.key_for(video_url, start_time, duration, output)
+        # Результаты для авторизованной сессии VK (приватные видео) не берутся из кэша и не кэшируются
+        use_cache = not (vk_username and vk_password)
+        
+        # Repeat conversions are served straight from the result cache
+        if use_cache and result_cache.restore(cache_key, unique_id):
+            storage.track(*find_outputs(unique_id))
+            set_task_state(unique_id, cached_state(output))
+            return jsonify({
+                'success': True,
+                'gif_id': unique_id,
+                'cached': True,
+                'message': 'Результат взят из кэша'
+            })
+        
+        # The same conversion is already running - attach to it instead of repeating the work.
+        # Запрос с данными VK не присоединяется и не принимает присоединённых: результат может быть приватным
+        primary_id = inflight_jobs.attach(cache_key, unique_id) if use_cache else None
+        if primary_id is not None:
+            set_task_state(unique_id, {
+                'progress': 0,
+                'status': 'Присоединено к идущей конвертации...',
+                'download_percent': 0,
+                'output_format': output['format'],
+                'attached_to': primary_id
+            })
+            return jsonify({
+                'success': True,
+                'gif_id': unique_id,
+                'attached': True,
+                'message': 'Такая же конвертация уже выполняется'
+            })
         
         # Initialize progress
-        progress_store[unique_id] = {'progress': 0, 'status': 'Подготовка...', 'download_percent': 0}
+        set_task_state(unique_id, {
+            'progress': 0,
+            'status': 'В очереди...',
+            'download_percent': 0,
+            'output_format': output['format'],
+            'queued': True,
+            'queued_at': time.time()
+        })
         
-        # Start processing in background thread
-        thread = threading.Thread(
-            target=process_video_task,
-            args=(unique_id, video_url, start_time, duration, vk_username, vk_password)
-        )
-        thread.daemon = True
-        thread.start()
+        # Put the task into the bounded queue served by the worker pool
+        position = enqueue_conversion(unique_id, video_url, start_time, duration, vk_username, vk_password, output)
+        if position is None:
+            drop_task(unique_id)
+            share_results(unique_id)
+            return overload_response()
         
         # Return task ID immediately
         return jsonify({
             'success': True,
             'gif_id': unique_id,
+            'queue_position': position,
             'message': 'Обработка началась'
         })
         
@@ -127,313 +1603,1573 @@ def convert_video():
         print(f"Ошибка: {str(e)}")
         return jsonify({'error': f'Ошибка: {str(e)}'}), 500
 
-def process_video_task(unique_id, video_url, start_time, duration, vk_username=None, vk_password=None):
-    """Background task for video processing"""
+@app.route('/convert/batch', methods=['POST'])
+def convert_batch():
+    """Пакетная конвертация: несколько клипов из одного видео.
+    
+    Тело: video_url, clips - список {start_time, duration} и параметры выхода
+    как в /convert. Видео извлекается один раз, близкие диапазоны скачиваются
+    общим окном. Ответ содержит batch_id и gif_id каждого клипа; сводный
+    прогресс - GET /batch/<batch_id>, прогресс клипа - как у обычной задачи.
+    """
     try:
-        video_path = TEMP_DIR / f"{unique_id}.mp4"
-        gif_path = TEMP_DIR / f"{unique_id}.gif"
+        data = request.json
+        video_url = data.get('video_url')
+        ranges = data.get('clips')
         
-        if is_direct_video_url(video_url):
-            print(f"Прямая ссылка на видео обнаружена: {video_url}")
-                        
-            buffer_before = max(0, start_time - 2)
-            total_duration = duration + 4
-                        
-            download_cmd = [
-                'ffmpeg',
-                '-ss', str(buffer_before),
-                '-to', str(buffer_before + total_duration),
-                '-i', video_url,
-                '-c', 'copy',
-                str(video_path),
-                '-y'
-            ]
-            
-            update_progress(unique_id, 20, 'Скачивание: 20% завершено', 30)
-            result = subprocess.run(download_cmd, capture_output=True, text=True)
-            
-            if result.returncode != 0:
-                print(f"Ошибка скачивания: {result.stderr}")
-                del progress_store[unique_id]
-                return
-            
-            update_progress(unique_id, 60, 'Скачивание завершено (100%)', 100)
-        else:
-            video_path_template = TEMP_DIR / f"{unique_id}.%(ext)s"
-            
-            # Calculate download range with buffer
-            buffer_before = max(0, start_time - 2)
-            buffer_after = duration + 4
-            download_start = buffer_before
-            download_end = buffer_before + buffer_after
-            
-            print(f"Диапазон загрузки: {download_start}s - {download_end}s (всего {download_end - download_start}s вместо полного видео)")
-            
-            # Use download_ranges to download only needed segment
-            from yt_dlp.utils import download_range_func
+        if not video_url or not isinstance(ranges, list) or not ranges:
+            return jsonify({'error': 'Указаны не все параметры'}), 400
+        if len(ranges) > MAX_BATCH_CLIPS:
+            return jsonify({'error': f'Не больше {MAX_BATCH_CLIPS} клипов в пакете'}), 400
+        
+        output, output_error = parse_output_options(data)
+        if output_error:
+            return jsonify({'error': output_error}), 400
+        
+        parsed = [parse_clip_range(item) for item in ranges]
+        for number, clip_range in enumerate(parsed, 1):
+            if clip_range is None:
+                return jsonify({'error': f'Клип {number}: нужен объект с числовыми start_time и duration'}), 400
+        
+        batch_id = str(uuid.uuid4())
+        clips = []
+        pending = []
+        for start_time, duration in parsed:
+            gif_id = str(uuid.uuid4())
             
-            # Special handling for VK videos
-            if is_vk_video(video_url):
-                print(f"Обнаружено VK видео, используем специальные настройки")
-                ydl_opts = {
-                    'format': 'best',
-                    'outtmpl': str(video_path_template),
-                    'quiet': False,
-                    'no_warnings': False,
-                    'progress_hooks': [lambda d: progress_hook(d, unique_id)],
-                    'nocheckcertificate': True,
-                    'http_headers': {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
-                        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-                        'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-                        'Referer': 'https://vk.com/',
-                        'Origin': 'https://vk.com',
-                        'Sec-Fetch-Dest': 'document',
-                        'Sec-Fetch-Mode': 'navigate',
-                        'Sec-Fetch-Site': 'none',
-                    },
-                    'download_ranges': download_range_func(None, [(download_start, download_end)]),
-                    'force_keyframes_at_cuts': True,
-                    'extractor_args': {
-                        'vk': {
-                            'is_authorized': True,
-                        }
-                    },
-                }
-                
-                # Add VK credentials if provided
-                if vk_username and vk_password:
-                    print(f"Используем предоставленные данные VK для авторизации")
-                    ydl_opts['username'] = vk_username
-                    ydl_opts['password'] = vk_password
+            cached = result_cache.restore(result_cache.key_for(video_url, start_time, duration, output), gif_id)
+            if cached:
+                storage.track(*find_outputs(gif_id))
+                set_task_state(gif_id, cached_state(output))
             else:
-                ydl_opts = {
-                    'format': 'best[ext=mp4]/best',
-                    'outtmpl': str(video_path_template),
-                    'quiet': False,
-                    'no_warnings': False,
-                    'geo_bypass': True,
-                    'nocheckcertificate': True,
-                    'progress_hooks': [lambda d: progress_hook(d, unique_id)],
-                    'http_headers': {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-                        'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-                        'Accept-Encoding': 'gzip, deflate, br',
-                        'Referer': 'https://vk.com/',
-                    },
-                    'download_ranges': download_range_func(None, [(download_start, download_end)]),
-                    'force_keyframes_at_cuts': True,
-                    'extractor_args': {'vk': {'allow_unplayable_formats': True}},
+                set_task_state(gif_id, {
+                    'progress': 0,
+                    'status': 'В очереди (пакет)...',
+                    'download_percent': 0,
+                    'output_format': output['format'],
+                    'batch_id': batch_id
+                })
+                pending.append({'task_id': gif_id, 'start_time': start_time, 'duration': duration})
+            clips.append({'gif_id': gif_id, 'start_time': start_time, 'duration': duration, 'cached': cached})
+        
+        set_task_state(batch_id, batch_state(clips, output))
+        
+        position = 0
+        if pending:
+            position = enqueue_batch(batch_id, video_url, pending, output)
+            if position is None:
+                for clip in clips:
+                    cleanup_task_files(clip['gif_id'])
+                drop_task(batch_id)
+                return overload_response()
+        else:
+            task_store.update(batch_id, {'queued': None, 'queued_at': None, 'status': 'Пакет обработан'})
+        
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'gif_ids': [clip['gif_id'] for clip in clips],
+            'clips': clips,
+            'queue_position': position,
+            'message': 'Обработка началась'
+        })
+        
+    except Exception as e:
+        print(f"Ошибка: {str(e)}")
+        return jsonify({'error': f'Ошибка: {str(e)}'}), 500
+
+def parse_clip_range(item):
+    """Фрагмент клипа пакета: (start_time, duration) или None, если клип задан неверно"""
+    if not isinstance(item, dict):
+        return None
+    try:
+        start_time = int(item.get('start_time', 10))
+        duration = int(item.get('duration', 3))
+    except (TypeError, ValueError):
+        return None
+    return start_time, min(10, max(1, duration))
+
+def cached_state(output):
+    """Состояние задачи, результат которой взят из кэша"""
+    return {
+        'progress': 100,
+        'status': f"Готово! {output['format'].upper()} и изображение созданы",
+        'download_percent': 100,
+        'output_format': output['format'],
+        'cached': True
+    }
+
+def overload_response():
+    """Ответ 503, когда очередь задач заполнена"""
+    response = jsonify({
+        'error': 'Сервер перегружен, попробуйте позже',
+        'queue_position': job_queue.max_depth + 1,
+        'queue_depth': len(job_queue)
+    })
+    response.headers['Retry-After'] = '10'
+    return response, 503
+
+def parse_output_options(data):
+    """Параметры выхода из запроса: (output, None) или (None, текст ошибки)"""
+    output_format = str(data.get('output_format') or 'gif').lower()
+    if output_format not in OUTPUT_FORMATS:
+        return None, f'Неподдерживаемый формат: {output_format}'
+    profile = str(data.get('profile') or ENCODE_PROFILE).lower()
+    if profile != 'auto' and profile not in ENCODE_PROFILES:
+        return None, f'Неизвестный профиль кодирования: {profile}'
+    output = {'format': output_format, 'target_size': None, 'quality': None, 'profile': profile}
+    try:
+        if data.get('target_size'):
+            output['target_size'] = int(data['target_size'])
+            if output['target_size'] < 16 * 1024:
+                return None, 'Целевой размер должен быть не меньше 16 КБ'
+        if data.get('quality'):
+            output['quality'] = min(100, max(1, int(data['quality'])))
+    except (TypeError, ValueError):
+        return None, 'Некорректный target_size или quality'
+    return output, None
+
+def uses_two_pass(output):
+    """Двухпроходный режим применяется только к GIF с параметрами по умолчанию"""
+    return GIF_ENCODE_MODE == 'two_pass' and output == DEFAULT_OUTPUT
+
+def streaming_available(output=DEFAULT_OUTPUT):
+    return STREAMING_ENABLED and not uses_two_pass(output)
+
+def chosen_video_format(info):
+    """Видеоформат, выбранный yt-dlp"""
+    formats = info.get('requested_formats') or [info]
+    video_formats = [f for f in formats if f.get('vcodec') != 'none'] or formats
+    return video_formats[0]
+
+def fragment_keyframes(fmt):
+    """Начала фрагментов HLS/DASH (каждый фрагмент начинается с ключевого кадра) или None"""
+    fragments = fmt.get('fragments')
+    if not fragments or any(fragment.get('duration') is None for fragment in fragments):
+        return None
+    keyframes, position = [], 0.0
+    for fragment in fragments:
+        keyframes.append(round(position, 3))
+        position += fragment['duration']
+    return keyframes
+
+def media_source_from_info(info):
+    """Прямой URL выбранного формата из результата yt-dlp или None, если ffmpeg не может читать его напрямую"""
+    chosen = chosen_video_format(info)
+    if not chosen.get('url') or chosen.get('protocol', 'https') not in STREAMABLE_PROTOCOLS:
+        return None
+    # Форматы, которым нужны cookies сессии yt-dlp, скачиваются через сам yt-dlp
+    if chosen.get('cookies'):
+        return None
+    return {
+        'input': chosen['url'],
+        'headers': chosen.get('http_headers') or info.get('http_headers') or {},
+        'keyframes': fragment_keyframes(chosen),
+    }
+
+def signed_url_expiry(url):
+    """Момент истечения подписанной CDN-ссылки (unix time) или None"""
+    parts = urlsplit(url)
+    params = {key.lower(): value for key, value in parse_qsl(parts.query)}
+    for name in ('expire', 'expires', 'exp', 'validto'):
+        if params.get(name, '').isdigit():
+            return int(params[name])
+    # Подпись AWS: X-Amz-Date=20240101T000000Z&X-Amz-Expires=3600
+    if params.get('x-amz-expires', '').isdigit() and 'x-amz-date' in params:
+        try:
+            signed_at = calendar.timegm(time.strptime(params['x-amz-date'], '%Y%m%dT%H%M%SZ'))
+        except ValueError:
+            return None
+        return int(signed_at) + int(params['x-amz-expires'])
+    # googlevideo иногда передаёт параметры в пути: /expire/1700000000/
+    match = re.search(r'/expire/(\d+)', parts.path)
+    if match:
+        return int(match.group(1))
+    return None
+
+class MetadataCache:
+    """Кэш результатов yt-dlp extract_info по URL страницы.
+    
+    Хранит info и прямой URL выбранного формата. Срок жизни записи не
+    превышает срок действия подписанной CDN-ссылки (с запасом).
+    """
+    
+    def __init__(self, max_entries, ttl, expiry_margin=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.expiry_margin = expiry_margin
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, video_url):
+        """(info, media) или None"""
+        key = normalize_video_url(video_url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires'] <= time.time():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry['info'], entry['media']
+    
+    def put(self, video_url, info, media):
+        expires = time.time() + self.ttl
+        if media is not None:
+            url_expiry = signed_url_expiry(media['input'])
+            if url_expiry is not None:
+                expires = min(expires, url_expiry - self.expiry_margin)
+        if expires <= time.time():
+            return
+        with self._lock:
+            self._entries[normalize_video_url(video_url)] = {'info': info, 'media': media, 'expires': expires}
+            self._entries.move_to_end(normalize_video_url(video_url))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, video_url):
+        with self._lock:
+            self._entries.pop(normalize_video_url(video_url), None)
+    
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+def build_ydl_opts(unique_id, video_url, start_time, duration, vk_username=None, vk_password=None):
+    """Параметры yt-dlp для извлечения информации и скачивания сегмента"""
+    video_path_template = SCRATCH_DIR / f"{unique_id}_segment.%(ext)s"
+    
+    # Calculate download range with buffer
+    buffer_before = max(0, start_time - 2)
+    buffer_after = duration + 4
+    download_start = buffer_before
+    download_end = buffer_before + buffer_after
+    
+    # Use download_ranges to download only needed segment
+    from yt_dlp.utils import download_range_func
+    
+    # Special handling for VK videos
+    if is_vk_video(video_url):
+        print(f"Обнаружено VK видео, используем специальные настройки")
+        ydl_opts = {
+            'format': 'best',
+            'outtmpl': str(video_path_template),
+            'quiet': False,
+            'no_warnings': False,
+            'progress_hooks': [lambda d: progress_hook(d, unique_id)],
+            'nocheckcertificate': True,
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36',
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+                'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+                'Referer': 'https://vk.com/',
+                'Origin': 'https://vk.com',
+                'Sec-Fetch-Dest': 'document',
+                'Sec-Fetch-Mode': 'navigate',
+                'Sec-Fetch-Site': 'none',
+            },
+            'download_ranges': download_range_func(None, [(download_start, download_end)]),
+            'force_keyframes_at_cuts': True,
+            'extractor_args': {
+                'vk': {
+                    'is_authorized': True,
                 }
-            
-            progress_store[unique_id] = {'progress': 2, 'status': 'Подключение к серверу...', 'download_percent': 0}
-            print(f"Скачивание видео: {video_url}")
-            
-            try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(video_url, download=True)
-                    print(f"Видео скачано: {info.get('title', 'Unknown')}")
-            except Exception as dl_error:
-                error_msg = str(dl_error)
-                print(f"Ошибка: {error_msg}")
-                
-                # Check if it's a VK authentication error
-                if is_vk_video(video_url) and ('badbrowser' in error_msg.lower() or 'unsupported url' in error_msg.lower() or 'redirect' in error_msg.lower()):
-                    if not vk_username or not vk_password:
-                        # VK auth is needed
-                        progress_store[unique_id] = {
-                            'progress': 0,
-                            'status': 'Требуется авторизация VK',
-                            'download_percent': 0,
-                            'error': True,
-                            'needs_vk_auth': True
-                        }
-                        return
-                    else:
-                        # VK auth failed even with credentials
-                        progress_store[unique_id] = {
-                            'progress': 0,
-                            'status': f'Ошибка авторизации VK: неверный логин или пароль',
-                            'download_percent': 0,
-                            'error': True
-                        }
-                        return
-                
-                del progress_store[unique_id]
-                return
-            
-            possible_files = list(TEMP_DIR.glob(f"{unique_id}.*"))
-            video_files = [f for f in possible_files if f.suffix.lower() in ['.mp4', '.webm', '.mkv', '.avi', '.mov', '.flv']]
-            
-            if not video_files:
-                del progress_store[unique_id]
-                return
-            
-            video_path = video_files[0]
+            },
+        }
         
-        print(f"Используется видео: {video_path}")
+        # Add VK credentials if provided
+        if vk_username and vk_password:
+            print(f"Используем предоставленные данные VK для авторизации")
+            ydl_opts['username'] = vk_username
+            ydl_opts['password'] = vk_password
+    else:
+        ydl_opts = {
+            'format': 'best[ext=mp4]/best',
+            'outtmpl': str(video_path_template),
+            'quiet': False,
+            'no_warnings': False,
+            'geo_bypass': True,
+            'nocheckcertificate': True,
+            'progress_hooks': [lambda d: progress_hook(d, unique_id)],
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+                'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+                'Accept-Encoding': 'gzip, deflate, br',
+                'Referer': 'https://vk.com/',
+            },
+            'download_ranges': download_range_func(None, [(download_start, download_end)]),
+            'force_keyframes_at_cuts': True,
+            'extractor_args': {'vk': {'allow_unplayable_formats': True}},
+        }
+    ydl_opts['socket_timeout'] = YTDLP_SOCKET_TIMEOUT
+    # Диапазон (download_ranges) скачивает ffmpeg, запущенный самим yt-dlp: он не вызывает
+    # progress-хуки и не виден supervisor, поэтому зависшее чтение ограничивается rw_timeout (мкс)
+    ydl_opts['external_downloader_args'] = {'ffmpeg_i': ['-rw_timeout', str(YTDLP_SOCKET_TIMEOUT * 1000000)]}
+    return ydl_opts
+
+def segment_range(start_time, duration, keyframe=None):
+    """Диапазон скачивания сегмента: от ключевого кадра до конца клипа или с запасом -2/+4 с"""
+    if keyframe is not None:
+        return keyframe, start_time + duration + KEYFRAME_TAIL
+    buffer_before = max(0, start_time - 2)
+    return buffer_before, buffer_before + duration + 4
+
+def segment_source(video_path, start_time, range_start):
+    """Источник из скачанного сегмента, который начинается с range_start исходного видео"""
+    return {
+        'input': video_path,
+        'headers': {},
+        'seek': start_time - range_start,  # Offset from segment start
+        'streamed': False,
+    }
+
+def nearest_keyframe(keyframes, time_point):
+    """Последний ключевой кадр не позже time_point или None"""
+    prior = [keyframe for keyframe in keyframes if keyframe <= time_point]
+    return max(prior) if prior else None
+
+def run_ffprobe(media, *args):
+    """Запуск ffprobe для источника: stdout или None при ошибке"""
+    probe_cmd = ['ffprobe', '-v', 'error', *http_input_args(media['headers']), *args, media['input']]
+    try:
+        result = subprocess.run(probe_cmd, capture_output=True, text=True, timeout=PROBE_TIMEOUT)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"Ошибка ffprobe: {e}")
+        return None
+    if result.returncode != 0:
+        print(f"Ошибка ffprobe: {result.stderr[-500:]}")
+        return None
+    return result.stdout
+
+def probe_start_time(media):
+    """start_time контейнера: у MPEG-TS/HLS временные метки начинаются не с нуля"""
+    output = run_ffprobe(media, '-show_entries', 'format=start_time', '-of', 'csv=p=0')
+    if output is None:
+        return None
+    try:
+        return float(output.strip().splitlines()[0])
+    except (IndexError, ValueError):
+        return 0.0
+
+def probe_keyframes(media, start_time, lookbehind=KEYFRAME_LOOKBEHIND):
+    """Ключевые кадры видеопотока перед start_time по данным ffprobe.
+    
+    ffprobe читает только пакеты интервала [start_time - lookbehind, start_time]
+    (для MP4 по HTTP - байтовые диапазоны из индекса moov, для HLS - нужные фрагменты)
+    и ничего не декодирует. -read_intervals и pts_time - абсолютные метки, а -ss
+    у ffmpeg отсчитывается от start_time контейнера, поэтому времена сдвигаются на
+    него. Возвращает (интервал, ключевые кадры) в секундах от начала видео или None.
+    """
+    offset = probe_start_time(media)
+    if offset is None:
+        return None
+    probe_start = max(0, start_time - lookbehind)
+    output = run_ffprobe(
+        media,
+        '-select_streams', 'v:0',
+        '-read_intervals', f'{offset + probe_start}%{offset + start_time}',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0'
+    )
+    if output is None:
+        return None
+    
+    keyframes = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags:
+            try:
+                keyframes.append(round(float(pts_time) - offset, 6))
+            except ValueError:
+                continue
+    return (probe_start, start_time), sorted(keyframes)
+
+class KeyframeIndex:
+    """Проверенные ffprobe интервалы источников и найденные в них ключевые кадры.
+    
+    Повторные клипы и пакеты из того же источника не запускают ffprobe снова,
+    если начало клипа попадает в уже проверенный интервал.
+    """
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # input -> [(probe_start, probe_end, keyframes)]
+        self._lock = threading.Lock()
+    
+    def lookup(self, media_input, time_point):
+        with self._lock:
+            for probe_start, probe_end, keyframes in self._entries.get(media_input, []):
+                if probe_start <= time_point <= probe_end:
+                    keyframe = nearest_keyframe(keyframes, time_point)
+                    if keyframe is not None:
+                        self._entries.move_to_end(media_input)
+                        return keyframe
+            return None
+    
+    def add(self, media_input, interval, keyframes):
+        with self._lock:
+            self._entries.setdefault(media_input, []).append((*interval, keyframes))
+            self._entries.move_to_end(media_input)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+keyframe_index = KeyframeIndex(METADATA_CACHE_SIZE)
+
+def prior_keyframe(task_id, media, start_time):
+    """Ближайший ключевой кадр не позже start_time или None (тогда сегмент берётся с запасом)"""
+    if SEEK_MODE != 'keyframe':
+        return None
+    if media.get('keyframes'):
+        return nearest_keyframe(media['keyframes'], start_time)
+    keyframe = keyframe_index.lookup(media['input'], start_time)
+    if keyframe is not None:
+        return keyframe
+    with StageSpan(task_id, 'probe'):
+        probed = probe_keyframes(media, start_time)
+    if probed is None:
+        return None
+    interval, keyframes = probed
+    keyframe_index.add(media['input'], interval, keyframes)
+    return nearest_keyframe(keyframes, start_time)
+
+def build_fetch_command(media, range_start, range_end, video_path):
+    """Команда ffmpeg для скачивания [range_start, range_end] с копированием потоков"""
+    return [
+        'ffmpeg',
+        *http_input_args(media['headers']),
+        '-ss', str(range_start),
+        '-to', str(range_end),
+        '-i', media['input'],
+        '-c', 'copy',
+        str(video_path),
+        '-y'
+    ]
+
+def fetch_range(task_id, media, range_start, range_end, video_path):
+    """Ranged-скачивание [range_start, range_end] ffmpeg'ом с копированием потоков: код возврата"""
+    download_cmd = build_fetch_command(media, range_start, range_end, video_path)
+    
+    with StageSpan(task_id, 'fetch') as span:
+        returncode, stderr = run_ffmpeg(download_cmd, span)
+        span.bytes_downloaded = output_size(video_path)
+    if returncode != 0:
+        print(f"Ошибка скачивания: {stderr}")
+    else:
+        storage.track(video_path)
+    return returncode
+
+def fetch_segment(unique_id, media, start_time, duration):
+    """Ranged-скачивание сегмента ffmpeg'ом с копированием потоков (без перекодирования)"""
+    video_path = SCRATCH_DIR / f"{unique_id}_segment.mp4"
+    
+    # Начиная с ключевого кадра, копирование потоков не требует запаса перед клипом
+    range_start, range_end = segment_range(start_time, duration, prior_keyframe(unique_id, media, start_time))
+    
+    update_progress(unique_id, 20, 'Скачивание: 20% завершено', 30)
+    returncode = fetch_range(unique_id, media, range_start, range_end, video_path)
+    
+    if returncode != 0:
+        metrics.count_error('download')
+        drop_task(unique_id)
+        return None
+    
+    update_progress(unique_id, 60, 'Скачивание завершено (100%)', 100)
+    return segment_source(video_path, start_time, range_start)
+
+def media_to_source(unique_id, media, start_time, duration, output=DEFAULT_OUTPUT):
+    """Источник для кодирования по прямому URL: поток в ffmpeg или ranged-скачивание сегмента"""
+    if streaming_available(output):
+        update_progress(unique_id, 20, 'Потоковая обработка видео...', 100)
+        return dict(media, seek=start_time, streamed=True)
+    return fetch_segment(unique_id, media, start_time, duration)
+
+def extract_media(task_id, video_url, ydl_opts, use_metadata_cache=True):
+    """Извлечение метаданных через кэш: (info, media). Ошибки yt-dlp пробрасываются вызывающему"""
+    with StageSpan(task_id, 'extract'):
+        cached = metadata_cache.get(video_url) if use_metadata_cache else None
+        if cached is not None:
+            info, media = cached
+        else:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(video_url, download=False)
+            media = media_source_from_info(info)
+            if use_metadata_cache:
+                metadata_cache.put(video_url, info, media)
+    task_store.update(task_id, {'metadata_cached': cached is not None})
+    return info, media
+
+def download_video_segment(unique_id, video_url, start_time, duration, vk_username=None, vk_password=None, output=DEFAULT_OUTPUT):
+    """Стадия скачивания: возвращает источник для кодирования или None, если продолжать не нужно.
+    
+    Источник - словарь с ключами input (URL или путь к сегменту), headers,
+    seek (смещение начала GIF во входе) и streamed (без промежуточного файла).
+    """
+    if is_direct_video_url(video_url):
+        print(f"Прямая ссылка на видео обнаружена: {video_url}")
+        return media_to_source(unique_id, {'input': video_url, 'headers': {}}, start_time, duration, output)
+    
+    # Обновление, а не замена: output_format и span очереди уже записаны в состояние
+    update_progress(unique_id, 2, 'Подключение к серверу...', 0)
+    print(f"Скачивание видео: {video_url}")
+    
+    ydl_opts = build_ydl_opts(unique_id, video_url, start_time, duration, vk_username, vk_password)
+    # Результаты для авторизованной сессии VK не кэшируются
+    use_cache = not (vk_username and vk_password)
+    
+    try:
+        info, media = extract_media(unique_id, video_url, ydl_opts, use_cache)
         
-        update_progress(unique_id, 70, 'Обработка видео...', 100)
+        # Другая ссылка на уже сконвертированное видео - берём результат из кэша
+        if use_cache:
+            result_cache.remember_source(video_url, info)
+        if use_cache and result_cache.restore(result_cache.key_for(video_url, start_time, duration, output), unique_id, recheck=True):
+            storage.track(*find_outputs(unique_id))
+            update_progress(unique_id, 100, 'Готово! GIF и изображение созданы', 100)
+            return None
         
-        # Calculate the seek position within the downloaded segment
-        # The video segment starts at (start_time - 2), so we need to seek to the offset within it
-        buffer_before = max(0, start_time - 2)
-        gif_seek_time = start_time - buffer_before  # Offset from segment start (typically 2 seconds)
+        if media is None:
+            # Формат нельзя читать ffmpeg напрямую - сегмент скачивает сам yt-dlp.
+            # Если известны границы фрагментов, режем по ключевому кадру без перекодирования
+            keyframes = fragment_keyframes(chosen_video_format(info)) if SEEK_MODE == 'keyframe' else None
+            keyframe = nearest_keyframe(keyframes, start_time) if keyframes else None
+            range_start, range_end = segment_range(start_time, duration, keyframe)
+            if keyframe is not None:
+                ydl_opts['download_ranges'] = yt_dlp.utils.download_range_func(None, [(range_start, range_end)])
+                ydl_opts.pop('force_keyframes_at_cuts', None)
+            print(f"Диапазон загрузки: {range_start}s - {range_end}s (всего {range_end - range_start}s вместо полного видео)")
+            with StageSpan(unique_id, 'fetch') as span:
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    info = ydl.process_ie_result(info, download=True)
+                span.bytes_downloaded = output_size(*SCRATCH_DIR.glob(f"{unique_id}_segment.*"))
+            print(f"Видео скачано: {info.get('title', 'Unknown')}")
+    except Exception as dl_error:
+        # Скачивание прервано progress-хуком из-за отмены или срока стадии
+        supervisor.check(unique_id)
+        error_msg = str(dl_error)
+        print(f"Ошибка: {error_msg}")
         
-        # High-quality GIF creation using two-pass palette generation
-        palette_path = TEMP_DIR / f"{unique_id}_palette.png"
+        # Check if it's a VK authentication error
+        if is_vk_video(video_url) and ('badbrowser' in error_msg.lower() or 'unsupported url' in error_msg.lower() or 'redirect' in error_msg.lower()):
+            metrics.count_error('vk_auth')
+            if not vk_username or not vk_password:
+                # VK auth is needed
+                set_task_state(unique_id, {
+                    'progress': 0,
+                    'status': 'Требуется авторизация VK',
+                    'download_percent': 0,
+                    'error': True,
+                    'needs_vk_auth': True
+                })
+                return None
+            else:
+                # VK auth failed even with credentials
+                set_task_state(unique_id, {
+                    'progress': 0,
+                    'status': f'Ошибка авторизации VK: неверный логин или пароль',
+                    'download_percent': 0,
+                    'error': True
+                })
+                return None
         
-        update_progress(unique_id, 75, 'Генерация цветовой палитры...', 100)
+        metrics.count_error('download')
+        drop_task(unique_id)
+        return None
+    
+    video = video_info_from_format(chosen_video_format(info))
+    if media is not None:
+        print(f"Прямой URL формата получен: {info.get('title', 'Unknown')}")
+        source = media_to_source(unique_id, media, start_time, duration, output)
+        if source is None:
+            metadata_cache.invalidate(video_url)
+        else:
+            source['video'] = video
+        return source
+    
+    possible_files = list(SCRATCH_DIR.glob(f"{unique_id}_segment.*"))
+    video_files = [f for f in possible_files if f.suffix.lower() in ['.mp4', '.webm', '.mkv', '.avi', '.mov', '.flv']]
+    
+    if not video_files:
+        metrics.count_error('download')
+        drop_task(unique_id)
+        return None
+    
+    storage.track(*possible_files)
+    return dict(segment_source(video_files[0], start_time, range_start), video=video)
+
+def http_input_args(headers):
+    """Опции ffmpeg для чтения по HTTP с заголовками источника"""
+    if not headers:
+        return []
+    return ['-headers', ''.join(f'{key}: {value}\r\n' for key, value in headers.items())]
+
+def build_two_pass_commands(video_path, seek_time, duration, gif_path, image_path, palette_path):
+    """Команды ffmpeg для двухпроходного режима: палитра, GIF по палитре, превью"""
+    # Step 1: Generate optimized color palette
+    palette_cmd = [
+        'ffmpeg',
+        '-ss', str(seek_time),
+        '-t', str(duration),
+        '-i', str(video_path),
+        '-vf', f'{GIF_VIDEO_FILTER},{GIF_PALETTEGEN}',
+        str(palette_path),
+        '-y'
+    ]
+    
+    # Step 2: Create high-quality GIF using the palette
+    gif_cmd = [
+        'ffmpeg',
+        '-ss', str(seek_time),
+        '-t', str(duration),
+        '-i', str(video_path),
+        '-i', str(palette_path),
+        '-lavfi', f'{GIF_VIDEO_FILTER}[x];[x][1:v]{GIF_PALETTEUSE}',
+        '-loop', '0',
+        str(gif_path),
+        '-y'
+    ]
+    
+    # Step 3: First frame as a JPG preview
+    image_cmd = [
+        'ffmpeg',
+        '-ss', str(seek_time),  # Используем тот же момент времени, что и для GIF
+        '-i', str(video_path),  # Используем оригинальный путь
+        '-vframes', '1',
+        '-q:v', '2',  # Высокое качество
+        str(image_path),
+        '-y'
+    ]
+    return palette_cmd, gif_cmd, image_cmd
+
+def worker_load():
+    """Нагрузка: задачи (в работе и в очереди) на обработчик или load average на ядро - что больше"""
+    tasks = (job_queue.active + len(job_queue)) / JOB_WORKERS
+    try:
+        system = os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        system = 0.0
+    return max(tasks, system)
+
+def video_info_from_format(fmt):
+    """Размер кадра и fps из формата yt-dlp или None"""
+    if not fmt.get('width') or not fmt.get('height'):
+        return None
+    return {'width': fmt['width'], 'height': fmt['height'], 'fps': fmt.get('fps')}
+
+def probe_video_stream(task_id, source):
+    """Размер кадра и fps видеопотока источника по данным ffprobe или None"""
+    probe_cmd = [
+        'ffprobe', '-v', 'error',
+        *http_input_args(source['headers']),
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,avg_frame_rate',
+        '-of', 'json',
+        str(source['input'])
+    ]
+    try:
+        with StageSpan(task_id, 'probe'):
+            result = subprocess.run(probe_cmd, capture_output=True, text=True, timeout=PROBE_TIMEOUT)
+        stream = json.loads(result.stdout)['streams'][0]
+        numerator, _, denominator = stream.get('avg_frame_rate', '0/1').partition('/')
+        fps = float(numerator) / float(denominator or 1) if float(denominator or 1) else None
+        return {'width': int(stream['width']), 'height': int(stream['height']), 'fps': fps or None}
+    except (OSError, subprocess.TimeoutExpired, ValueError, KeyError, IndexError) as e:
+        print(f"Не удалось получить параметры видео: {e}")
+        return None
+
+def resolve_profile(output, video=None):
+    """Параметры кодирования: пресет, поправка на источник (без увеличения) и, для auto, на нагрузку.
+    
+    Возвращает словарь пресета с полями name, requested и degraded (пресет
+    понижен из-за нагрузки - такой результат не кэшируется).
+    """
+    requested = output.get('profile') or ENCODE_PROFILE
+    name, degraded = ('standard' if requested == 'auto' else requested), False
+    if requested == 'auto':
+        load = worker_load()
+        for threshold, cheaper in LOAD_DEGRADE_STEPS:
+            if load >= threshold:
+                name, degraded = cheaper, True
+                break
+    profile = dict(ENCODE_PROFILES[name], name=name, requested=requested, degraded=degraded)
+    
+    if video:
+        if video.get('fps'):
+            profile['fps'] = max(1, min(profile['fps'], round(video['fps'])))
+        source_width = video['width'] - video['width'] % 2
+        if source_width <= profile['width']:
+            profile['width'] = source_width
+        elif requested == 'auto' and source_width >= 2 * profile['width']:
+            # Сильное уменьшение: area дешевле lanczos и не даёт алиасинга
+            profile['scaler'] = 'area'
+    return profile
+
+def encode_ladder(output, duration, profile=None):
+    """Ступени (ширина, fps) для кодирования. Без целевого размера - только параметры профиля.
+    
+    Ступени не выше профиля; стартовая - первая, чья оценка размера
+    (16:9, BYTES_PER_PIXEL) укладывается в цель.
+    """
+    top = (profile['width'], profile['fps']) if profile else ENCODE_LADDER[0]
+    if not output.get('target_size'):
+        return [top]
+    ladder = []
+    for width, fps in [top] + ENCODE_LADDER:
+        step = (min(width, top[0]), min(fps, top[1]))
+        if step not in ladder:
+            ladder.append(step)
+    bytes_per_pixel = BYTES_PER_PIXEL[output['format']]
+    start = len(ladder) - 1
+    for index, (width, fps) in enumerate(ladder):
+        estimate = width * (width * 9 / 16) * fps * duration * bytes_per_pixel
+        if estimate <= output['target_size']:
+            start = index
+            break
+    return ladder[start:start + MAX_ENCODE_ATTEMPTS]
+
+def output_codec_args(output, duration):
+    """Опции кодека для WebP/MP4/AVIF: качество или битрейт под целевой размер"""
+    quality = output.get('quality')
+    target_size = output.get('target_size')
+    # 90% цели на видеопоток, остальное - запас на контейнер
+    bitrate = int(target_size * 8 * 0.9 / duration) if target_size else None
+    
+    if output['format'] == 'webp':
+        return ['-c:v', 'libwebp_anim', '-lossless', '0', '-q:v', str(quality or 75), '-loop', '0']
+    if output['format'] == 'mp4':
+        args = ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-movflags', '+faststart']
+        if bitrate:
+            return args + ['-b:v', str(bitrate), '-maxrate', str(bitrate), '-bufsize', str(bitrate * 2)]
+        return args + ['-crf', str(round(51 - (quality or 80) * 0.35))]
+    if output['format'] == 'avif':
+        args = ['-c:v', 'libaom-av1', '-cpu-used', '8', '-row-mt', '1', '-pix_fmt', 'yuv420p', '-f', 'avif']
+        if bitrate:
+            return args + ['-b:v', str(bitrate)]
+        return args + ['-crf', str(round(63 - (quality or 70) * 0.45)), '-b:v', '0']
+    raise ValueError(f"Нет параметров кодека для формата {output['format']}")
+
+def build_single_pass_command(video_path, seek_time, duration, output_path, image_path, input_args=(),
+                              output=DEFAULT_OUTPUT, width=640, fps=20, scaler='lanczos',
+                              dither=ENCODE_PROFILES['standard']['dither']):
+    """Одна команда ffmpeg: анимация и превью из одного декодирования.
+    
+    Поток делится через split: одна ветка идёт в кодировщик (для GIF - через
+    palettegen и paletteuse), вторая отдаёт первый кадр во второй выход (JPG).
+    Вход может быть и файлом, и URL: при потоковой обработке ffmpeg сам читает
+    нужный диапазон.
+    """
+    if output['format'] == 'gif':
+        palettegen = GIF_PALETTEGEN
+        if output.get('quality'):
+            palettegen = f"palettegen=stats_mode=diff:max_colors={max(16, round(256 * output['quality'] / 100))}"
+        filter_graph = (
+            f'[0:v]split[g][t];'
+            f'[g]fps={fps},scale={width}:-1:flags={scaler},split[a][b];'
+            f'[a]{palettegen}[p];'
+            f'[b][p]paletteuse=dither={dither}:diff_mode=rectangle[out]'
+        )
+        codec_args = ['-loop', '0']
+    else:
+        # H.264/AV1 в yuv420p требуют чётных размеров кадра
+        filter_graph = f'[0:v]split[g][t];[g]fps={fps},scale={width}:-2:flags={scaler}[out]'
+        codec_args = output_codec_args(output, duration)
+    return [
+        'ffmpeg',
+        '-y',
+        *input_args,
+        '-ss', str(seek_time),
+        '-t', str(duration),
+        '-i', str(video_path),
+        '-filter_complex', filter_graph,
+        '-map', '[out]', *codec_args, str(output_path),
+        '-map', '[t]', '-frames:v', '1', '-q:v', '2', str(image_path),
+    ]
+
+def run_ffmpeg_with_progress(unique_id, cmd, expected_frames, progress_from, progress_to, status, span=None):
+    """Запуск ffmpeg с пересчётом frame= из stderr в прогресс задачи. Возвращает код возврата"""
+    frame_pattern = re.compile(r'frame=\s*(\d+)')
+    progress_span = progress_to - progress_from
+    
+    def on_line(line):
+        frame_match = frame_pattern.search(line)
+        if frame_match:
+            frame_num = int(frame_match.group(1))
+            estimated_progress = progress_from + min(progress_span, (frame_num / expected_frames) * progress_span)
+            update_progress(unique_id, estimated_progress, status, 100)
+    
+    returncode, _ = run_ffmpeg(cmd, span, on_line)
+    return returncode
+
+def gif_optimizer_available():
+    return np is not None
+
+def gif_optimizer_signature():
+    """Настройки оптимизатора GIF для ключа кэша (бюджет времени результат не определяет)"""
+    if not GIF_OPTIMIZE or not gif_optimizer_available():
+        return 'optimize=off'
+    return f'optimize=on,tolerance={GIF_FRAME_TOLERANCE},duplicates={GIF_DUPLICATE_RATIO}'
+
+def gif_frame_bytes(frame, palette, transparency):
+    """Кадр GIF (индексы палитры) со смещением, задержкой и прозрачностью"""
+    indices = frame['indices']
+    image = Image.frombytes('P', (indices.shape[1], indices.shape[0]), indices.tobytes())
+    image.putpalette(palette)
+    params = {'duration': frame['duration'], 'disposal': 1}
+    if transparency is not None:
+        params['transparency'] = transparency
+    return b''.join(GifImagePlugin.getdata(image, frame['offset'], **params))
+
+def build_optimized_gif(gif_path, deadline, tolerance=None, duplicate_ratio=None):
+    """Покадровая перепаковка GIF с той же палитрой.
+    
+    Каждый кадр сравнивается с тем, что уже показано на экране: почти не
+    изменившиеся кадры выбрасываются (их задержка прибавляется к предыдущему),
+    остальные обрезаются до прямоугольника изменений, а неизменившиеся пиксели
+    внутри него становятся прозрачными. Возвращает (байты GIF, кадров было,
+    кадров стало) или None, если не уложились в deadline. По умолчанию пороги берутся
+    из текущих GIF_FRAME_TOLERANCE и GIF_DUPLICATE_RATIO (те же, что в ключе кэша).
+    """
+    tolerance = GIF_FRAME_TOLERANCE if tolerance is None else tolerance
+    duplicate_ratio = GIF_DUPLICATE_RATIO if duplicate_ratio is None else duplicate_ratio
+    with Image.open(gif_path) as gif:
+        palette = gif.getpalette()
+        transparency = gif.info.get('transparency')
+        if transparency is None and len(palette) // 3 < 256:
+            transparency = len(palette) // 3
+            palette = palette + [0, 0, 0]
+        # Цвет прозрачного индекса не должен выбираться при сопоставлении цветов кадра с палитрой
+        match_palette = list(palette)
+        if transparency is not None:
+            match_palette[transparency * 3:transparency * 3 + 3] = palette[:3]
+        matcher = Image.new('P', (1, 1))
+        matcher.putpalette(match_palette)
+        header_info = {'loop': gif.info['loop']} if 'loop' in gif.info else {}
         
-        # Step 1: Generate optimized color palette
-        palette_cmd = [
-            'ffmpeg',
-            '-ss', str(gif_seek_time),
-            '-t', str(duration),
-            '-i', str(video_path),
-            '-vf', 'fps=20,scale=640:-1:flags=lanczos,palettegen=stats_mode=diff:max_colors=256',
-            str(palette_path),
-            '-y'
-        ]
+        chunks = []
+        pending = None
+        canvas = None
+        frames_in = 0
+        frames_out = 0
+        for frame in ImageSequence.Iterator(gif):
+            if time.monotonic() > deadline:
+                return None
+            frames_in += 1
+            rgb = np.asarray(frame.convert('RGB'), dtype=np.int16)
+            delay = frame.info.get('duration', 0)
+            if canvas is None:
+                changed = np.ones(rgb.shape[:2], dtype=bool)
+            else:
+                changed = np.abs(rgb - canvas).max(axis=2) > tolerance
+                if changed.mean() <= duplicate_ratio:
+                    pending['duration'] += delay
+                    continue
+            
+            rows = np.flatnonzero(changed.any(axis=1))
+            cols = np.flatnonzero(changed.any(axis=0))
+            top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            region = np.ascontiguousarray(rgb[top:bottom, left:right], dtype=np.uint8)
+            indices = np.array(Image.fromarray(region).quantize(palette=matcher, dither=Image.Dither.NONE))
+            if transparency is not None:
+                indices[indices == transparency] = 0
+                if canvas is not None:
+                    indices[~changed[top:bottom, left:right]] = transparency
+            
+            if canvas is None:
+                canvas = rgb.copy()
+                first = Image.frombytes('P', (indices.shape[1], indices.shape[0]), indices.tobytes())
+                first.putpalette(palette)
+                first.info['version'] = b'89a'  # задержки и прозрачность есть только в GIF89a
+                chunks.extend(GifImagePlugin.getheader(first, info=header_info)[0])
+            else:
+                canvas[changed] = rgb[changed]
+            if pending is not None:
+                chunks.append(gif_frame_bytes(pending, palette, transparency))
+            pending = {'indices': indices, 'offset': (int(left), int(top)), 'duration': delay}
+            frames_out += 1
         
+        if pending is None or time.monotonic() > deadline:
+            return None
+        chunks.append(gif_frame_bytes(pending, palette, transparency))
+        chunks.append(b';')
+        return b''.join(chunks), frames_in, frames_out
+
+def optimize_gif(task_id, gif_path, progress):
+    """Стадия оптимизации GIF в пределах GIF_OPTIMIZE_BUDGET; файл заменяется, только если стал меньше"""
+    if not GIF_OPTIMIZE:
+        return None
+    if not gif_optimizer_available():
+        task_store.update(task_id, {'optimize': {'status': 'unavailable'}})
+        return None
+    update_progress(task_id, progress, 'Оптимизация GIF...', 100)
+    bytes_before = gif_path.stat().st_size
+    started = time.monotonic()
+    with StageSpan(task_id, 'optimize') as span:
         try:
-            palette_result = subprocess.run(
-                palette_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            
-            if palette_result.returncode != 0:
-                print(f"Ошибка генерации палитры: {palette_result.stderr}")
-                del progress_store[unique_id]
-                return
+            optimized = build_optimized_gif(gif_path, started + GIF_OPTIMIZE_BUDGET)
         except Exception as e:
-            print(f"Ошибка при генерации палитры: {e}")
-            del progress_store[unique_id]
-            return
+            print(f"Ошибка оптимизации GIF {task_id}: {e}")
+            optimized = None
         
-        update_progress(unique_id, 80, 'Конвертация в GIF...', 100)
-        
-        # Step 2: Create high-quality GIF using the palette
-        ffmpeg_cmd = [
-            'ffmpeg',
-            '-ss', str(gif_seek_time),
-            '-t', str(duration),
-            '-i', str(video_path),
-            '-i', str(palette_path),
-            '-lavfi', 'fps=20,scale=640:-1:flags=lanczos[x];[x][1:v]paletteuse=dither=bayer:bayer_scale=5:diff_mode=rectangle',
-            '-loop', '0',
-            str(gif_path),
-            '-y'
-        ]
+        report = {'bytes_before': bytes_before, 'bytes_after': bytes_before, 'saved_bytes': 0}
+        if optimized is None:
+            report['status'] = 'skipped'
+        else:
+            data, frames_in, frames_out = optimized
+            report.update(frames_before=frames_in, frames_after=frames_out)
+            if len(data) < bytes_before:
+                temp_path = gif_path.with_name(gif_path.name + '.tmp')
+                temp_path.write_bytes(data)
+                os.replace(temp_path, gif_path)
+                report.update(status='optimized', bytes_after=len(data), saved_bytes=bytes_before - len(data))
+            else:
+                report['status'] = 'not_smaller'
+        span.output_bytes = report['bytes_after']
+    
+    report['seconds'] = round(time.monotonic() - started, 3)
+    metrics.count_optimized(report['saved_bytes'])
+    task_store.update(task_id, {'optimize': report})
+    print(f"Оптимизация GIF {task_id}: {report['status']}, сэкономлено {report['saved_bytes']} байт за {report['seconds']} с")
+    return report
+
+def encode_video_segment(unique_id, source, duration, mode=None, output=DEFAULT_OUTPUT):
+    """Стадия кодирования: анимация и превью из источника, подготовленного download_video_segment"""
+    if source['streamed'] or not uses_two_pass(output):
+        mode = 'single'
+    else:
+        mode = mode or GIF_ENCODE_MODE
+    video_path = source['input']
+    gif_seek_time = source['seek']
+    gif_path = TEMP_DIR / f"{unique_id}.gif"
+    image_path = TEMP_DIR / f"{unique_id}.jpg"
+    
+    print(f"Используется видео: {video_path} (режим кодирования: {mode})")
+    
+    # Ожидаемое количество кадров: duration * 20 FPS
+    expected_frames = duration * 20
+    
+    if mode == 'single':
+        output_path = TEMP_DIR / f"{unique_id}{OUTPUT_FORMATS[output['format']]['ext']}"
+        label = output['format'].upper()
+        # При потоковой обработке скачивание и кодирование идут одновременно
+        progress_from = 20 if source['streamed'] else 75
+        update_progress(unique_id, progress_from, f'Конвертация в {label}...', 100)
         
-        # Run FFmpeg with progress monitoring
-        try:
-            process = subprocess.Popen(
-                ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1
+        if not source.get('video'):
+            source['video'] = probe_video_stream(unique_id, source)
+        profile = resolve_profile(output, source['video'])
+        
+        # С целевым размером спускаемся по ступеням (ширина, fps), пока результат не уложится
+        ladder = encode_ladder(output, duration, profile)
+        for attempt, (width, fps) in enumerate(ladder, 1):
+            ffmpeg_cmd = build_single_pass_command(
+                video_path, gif_seek_time, duration, output_path, image_path,
+                input_args=http_input_args(source['headers']), output=output, width=width, fps=fps,
+                scaler=profile['scaler'], dither=profile['dither']
             )
+            try:
+                with StageSpan(unique_id, 'encode') as span:
+                    returncode = run_ffmpeg_with_progress(
+                        unique_id, ffmpeg_cmd, duration * fps, progress_from, 95, f'Конвертация в {label}...', span
+                    )
+                    span.output_bytes = output_size(output_path, image_path)
+            except Exception as e:
+                print(f"Ошибка при запуске FFmpeg: {e}")
+                metrics.count_error('encode')
+                drop_task(unique_id)
+                return False
             
-            # Monitor FFmpeg output for progress
-            import re as regex_module
-            frame_pattern = regex_module.compile(r'frame=\s*(\d+)')
-            # Ожидаемое количество кадров: duration * 20 FPS
-            expected_frames = duration * 20
-            
-            for line in process.stderr:
-                frame_match = frame_pattern.search(line)
-                if frame_match:
-                    frame_num = int(frame_match.group(1))
-                    # Рассчитываем прогресс от 80% до 90% (10% от общего прогресса на создание GIF)
-                    estimated_progress = 80 + min(10, (frame_num / expected_frames) * 10)
-                    update_progress(unique_id, estimated_progress, 'Конвертация в GIF...', 100)
+            if returncode != 0:
+                print(f"Ошибка FFmpeg")
+                metrics.count_error('download' if source['streamed'] and not output_path.exists() else 'encode')
+                drop_task(unique_id)
+                return False
             
-            process.wait()
-            result_returncode = process.returncode
-        except Exception as e:
-            print(f"Ошибка при запуске FFmpeg: {e}")
-            palette_path.unlink(missing_ok=True)
-            del progress_store[unique_id]
-            return
+            output_bytes = output_path.stat().st_size
+            if not output['target_size'] or output_bytes <= output['target_size'] or attempt == len(ladder):
+                break
+            print(f"{label} {output_bytes} байт больше цели {output['target_size']}, понижаем ширину и fps")
         
-        if result_returncode != 0:
-            print(f"Ошибка FFmpeg")
-            palette_path.unlink(missing_ok=True)
-            del progress_store[unique_id]
-            return
+        if output['format'] == 'gif' and optimize_gif(unique_id, output_path, 96):
+            output_bytes = output_path.stat().st_size
+        storage.track(output_path, image_path)
+        task_store.update(unique_id, {'encode': {
+            'format': output['format'],
+            'profile': profile['name'],
+            'requested_profile': profile['requested'],
+            'degraded': profile['degraded'],
+            'scaler': profile['scaler'],
+            'dither': profile['dither'] if output['format'] == 'gif' else None,
+            'width': width,
+            'fps': fps,
+            'source': source.get('video'),
+            'bytes': output_bytes,
+            'attempts': attempt,
+        }})
         
-        # Clean up palette file
-        palette_path.unlink(missing_ok=True)
-        
-        update_progress(unique_id, 90, 'Финализация...', 100)
-        
-        # Генерация изображения из первого кадра
-        image_path = TEMP_DIR / f"{unique_id}.jpg"
-        image_cmd = [
-            'ffmpeg',
-            '-ss', str(gif_seek_time),  # Используем тот же момент времени, что и для GIF
-            '-i', str(video_path),      # Используем оригинальный путь
-            '-vframes', '1',
-            '-q:v', '2',  # Высокое качество
-            str(image_path),
-            '-y'
-        ]
+        if not source['streamed'] and not source.get('shared'):
+            storage.discard(video_path)
         
-        try:
-            image_result = subprocess.run(
-                image_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            
-            if image_result.returncode != 0:
-                print(f"Ошибка генерации изображения: {image_result.stderr}")
-            else:
-                update_progress(unique_id, 95, 'Создание превью изображения...', 100)
-        except Exception as e:
-            print(f"Ошибка при генерации изображения: {e}")
+        update_progress(unique_id, 100, f'Готово! {label} и изображение созданы', 100)
+        return True
+    
+    update_progress(unique_id, 70, 'Обработка видео...', 100)
+    
+    # High-quality GIF creation using two-pass palette generation
+    palette_path = SCRATCH_DIR / f"{unique_id}_palette.png"
+    palette_cmd, ffmpeg_cmd, image_cmd = build_two_pass_commands(
+        video_path, gif_seek_time, duration, gif_path, image_path, palette_path
+    )
+    
+    update_progress(unique_id, 75, 'Генерация цветовой палитры...', 100)
+    
+    try:
+        with StageSpan(unique_id, 'palette') as span:
+            palette_returncode, palette_stderr = run_ffmpeg(palette_cmd, span)
         
-        video_path.unlink(missing_ok=True)
+        if palette_returncode != 0:
+            print(f"Ошибка генерации палитры: {palette_stderr}")
+            metrics.count_error('palette')
+            drop_task(unique_id)
+            return False
+        storage.track(palette_path)
+    except StorageFull:
+        raise
+    except Exception as e:
+        print(f"Ошибка при генерации палитры: {e}")
+        metrics.count_error('palette')
+        drop_task(unique_id)
+        return False
+    
+    update_progress(unique_id, 80, 'Конвертация в GIF...', 100)
+    
+    # Run FFmpeg with progress monitoring (80% - 90%)
+    try:
+        with StageSpan(unique_id, 'paletteuse') as span:
+            result_returncode = run_ffmpeg_with_progress(unique_id, ffmpeg_cmd, expected_frames, 80, 90, 'Конвертация в GIF...', span)
+            span.output_bytes = output_size(gif_path)
+    except Exception as e:
+        print(f"Ошибка при запуске FFmpeg: {e}")
+        metrics.count_error('encode')
+        storage.discard(palette_path)
+        drop_task(unique_id)
+        return False
+    
+    if result_returncode != 0:
+        print(f"Ошибка FFmpeg")
+        metrics.count_error('encode')
+        storage.discard(palette_path)
+        drop_task(unique_id)
+        return False
+    
+    # Clean up palette file
+    storage.discard(palette_path)
+    optimize_gif(unique_id, gif_path, 90)
+    
+    update_progress(unique_id, 90, 'Финализация...', 100)
+    
+    # Генерация изображения из первого кадра
+    try:
+        with StageSpan(unique_id, 'thumbnail') as span:
+            image_returncode, image_stderr = run_ffmpeg(image_cmd, span)
+            span.output_bytes = output_size(image_path)
         
-        update_progress(unique_id, 100, 'Готово! GIF и изображение созданы', 100)
+        if image_returncode != 0:
+            print(f"Ошибка генерации изображения: {image_stderr}")
+            metrics.count_error('thumbnail')
+        else:
+            update_progress(unique_id, 95, 'Создание превью изображения...', 100)
+    except Exception as e:
+        print(f"Ошибка при генерации изображения: {e}")
+    
+    storage.track(gif_path, image_path)
+    # Двухпроходный режим всегда кодирует параметрами standard (GIF_VIDEO_FILTER, GIF_PALETTEUSE)
+    standard = ENCODE_PROFILES['standard']
+    task_store.update(unique_id, {'encode': {
+        'format': 'gif',
+        'profile': 'standard',
+        'requested_profile': output.get('profile') or ENCODE_PROFILE,
+        'degraded': False,
+        'scaler': standard['scaler'],
+        'dither': standard['dither'],
+        'width': standard['width'],
+        'fps': standard['fps'],
+        'source': source.get('video'),
+        'bytes': output_size(gif_path),
+        'attempts': 1,
+    }})
+    if not source.get('shared'):
+        storage.discard(video_path)
+    
+    update_progress(unique_id, 100, 'Готово! GIF и изображение созданы', 100)
+    return True
+
+def result_cacheable(task_id):
+    """Результат, сделанный пониженным из-за нагрузки профилем или не оптимизированный
+    за бюджет времени (ключ кэша обещает оптимизацию), в кэш не попадает"""
+    state = get_task_state(task_id) or {}
+    if (state.get('optimize') or {}).get('status') == 'skipped':
+        return False
+    return not (state.get('encode') or {}).get('degraded')
+
+def cancelled_state(status):
+    return {'progress': 0, 'status': status, 'download_percent': 0, 'error': True, 'cancelled': True}
+
+def handle_storage_full(task_id, error):
+    """Место занято задачами в обработке: файлы задачи удаляются, клиент получает ошибку"""
+    print(f"Задача {task_id}: {error}")
+    metrics.count_error('storage')
+    storage.remove_task(task_id)
+    if get_task_state(task_id) is not None:
+        set_task_state(task_id, {
+            'progress': 0,
+            'status': 'Недостаточно места на сервере, попробуйте позже',
+            'download_percent': 0,
+            'error': True
+        })
+
+def handle_cancelled(task_id, cancelled):
+    """Остановленная задача: удаление промежуточных файлов и состояние отмены"""
+    print(f"Задача {task_id} остановлена: {cancelled.status}")
+    metrics.count_error('timeout' if cancelled.reason == 'timeout' else 'cancelled')
+    storage.remove_task(task_id)
+    # После /cleanup состояние уже удалено - не восстанавливаем его
+    if get_task_state(task_id) is not None:
+        set_task_state(task_id, cancelled_state(cancelled.status))
+
+def process_video_task(unique_id, video_url, start_time, duration, vk_username=None, vk_password=None, output=None):
+    """Background task for video processing"""
+    output = output or DEFAULT_OUTPUT
+    storage.pin(unique_id)
+    try:
+        # Сетевая стадия и CPU-стадия ограничиваются независимо
+        with download_slots:
+            with supervisor.stage(unique_id, 'download'):
+                source = download_video_segment(unique_id, video_url, start_time, duration, vk_username, vk_password, output)
+        
+        if source is None:
+            return
         
+        # Потоковый источник читается из сети прямо во время кодирования: такая стадия
+        # занимает и слот скачивания, чтобы медленный источник не обходил лимит скачиваний
+        streamed = source['streamed']
+        with download_slots if streamed else nullcontext():
+            with encode_slots:
+                with supervisor.stage(unique_id, 'stream' if streamed else 'encode'):
+                    encoded = encode_video_segment(unique_id, source, duration, output=output)
+        
+        # Результат авторизованной сессии VK может быть приватным - в общий кэш не попадает
+        if encoded and result_cacheable(unique_id) and not (vk_username and vk_password):
+            result_cache.store(result_cache.key_for(video_url, start_time, duration, output), unique_id)
+        elif not encoded and source['streamed']:
+            # Прямой URL мог истечь раньше срока - следующая задача извлечёт его заново
+            metadata_cache.invalidate(video_url)
+        
+    except StorageFull as e:
+        handle_storage_full(unique_id, e)
     except Exception as e:
         print(f"Ошибка в фоновой задаче: {str(e)}")
-        if unique_id in progress_store:
-            progress_store[unique_id] = {
+        metrics.count_error('internal')
+        if get_task_state(unique_id) is not None:
+            set_task_state(unique_id, {
                 'progress': 0,
                 'status': f'Ошибка: {str(e)}',
                 'download_percent': 0,
                 'error': True
-            }
+            })
+    except TaskCancelled as e:
+        handle_cancelled(unique_id, e)
+    finally:
+        storage.unpin(unique_id)
+        share_results(unique_id)
+        supervisor.forget(unique_id)
+
+def merge_clip_ranges(clips, gap=BATCH_MERGE_GAP):
+    """Объединение диапазонов клипов в окна скачивания.
+    
+    Каждый клип берётся с тем же запасом, что и одиночный сегмент (-2/+2 с);
+    пересекающиеся диапазоны и диапазоны ближе gap секунд попадают в одно окно.
+    Возвращает список {'start', 'end', 'clips'} по возрастанию start.
+    """
+    windows = []
+    for clip in sorted(clips, key=lambda c: c['start_time']):
+        start = max(0, clip['start_time'] - 2)
+        end = clip['start_time'] + clip['duration'] + 2
+        if windows and start - windows[-1]['end'] <= gap:
+            windows[-1]['end'] = max(windows[-1]['end'], end)
+            windows[-1]['clips'].append(clip)
+        else:
+            windows.append({'start': start, 'end': end, 'clips': [clip]})
+    return windows
+
+def fail_clip(task_id, status):
+    """Перевод клипа пакета в состояние ошибки (если клип не удалён клиентом)"""
+    if get_task_state(task_id) is not None:
+        set_task_state(task_id, {'progress': 0, 'status': status, 'download_percent': 0, 'error': True})
+
+def clip_pending(task_id):
+    """Клип пакета ещё нужно обрабатывать: не удалён через /cleanup и не отменён"""
+    state = get_task_state(task_id)
+    return state is not None and not state.get('error')
+
+def encode_batch_clip(clip, window, video_url, output):
+    """Кодирование одного клипа пакета из общего окна"""
+    task_id = clip['task_id']
+    if not clip_pending(task_id):
+        return
+    source = {
+        'input': window['path'],
+        'headers': {},
+        'seek': clip['start_time'] - window['start'],
+        'streamed': False,
+        'shared': True,  # Окно удаляется после всех его клипов
+        'video': window.get('video'),
+    }
+    try:
+        with encode_slots:
+            with supervisor.stage(task_id, 'encode'):
+                encoded = encode_video_segment(task_id, source, clip['duration'], output=output)
+        if encoded and result_cacheable(task_id):
+            result_cache.store(result_cache.key_for(video_url, clip['start_time'], clip['duration'], output), task_id)
+    except TaskCancelled as e:
+        handle_cancelled(task_id, e)
+    except StorageFull as e:
+        handle_storage_full(task_id, e)
+    except Exception as e:
+        print(f"Ошибка кодирования клипа {task_id}: {e}")
+        metrics.count_error('internal')
+        fail_clip(task_id, f'Ошибка: {str(e)}')
+    finally:
+        supervisor.forget(task_id)
+
+def process_batch_task(batch_id, video_url, clips, output=None):
+    """Фоновая задача пакета: одно извлечение, общие окна скачивания, параллельное кодирование.
+    
+    Окна скачиваются по очереди, а клипы уже скачанных окон кодируются
+    параллельно (в пределах encode_slots), пока скачивается следующее окно.
+    """
+    output = output or DEFAULT_OUTPUT
+    clips = [clip for clip in clips if clip_pending(clip['task_id'])]
+    if not clips:
+        return
+    windows = []
+    pinned = [batch_id] + [clip['task_id'] for clip in clips]
+    for owner in pinned:
+        storage.pin(owner)
+    try:
+        for clip in clips:
+            update_progress(clip['task_id'], 2, 'Подключение к серверу...', 0)
+        
+        video = None
+        if is_direct_video_url(video_url):
+            media = {'input': video_url, 'headers': {}}
+        else:
+            # Диапазон в опциях не важен: yt-dlp здесь только извлекает метаданные
+            ydl_opts = build_ydl_opts(batch_id, video_url, clips[0]['start_time'], clips[0]['duration'])
+            with supervisor.stage(batch_id, 'download'):
+                info, media = extract_media(batch_id, video_url, ydl_opts)
+            video = video_info_from_format(chosen_video_format(info))
+            result_cache.remember_source(video_url, info)
+            pending = []
+            for clip in clips:
+                key = result_cache.key_for(video_url, clip['start_time'], clip['duration'], output)
+                if result_cache.restore(key, clip['task_id'], recheck=True):
+                    storage.track(*find_outputs(clip['task_id']))
+                    update_progress(clip['task_id'], 100, f"Готово! {output['format'].upper()} и изображение созданы", 100)
+                else:
+                    pending.append(clip)
+            clips = pending
+            
+            if media is None:
+                # Формат читает только yt-dlp - клипы скачиваются по отдельности
+                for clip in clips:
+                    process_video_task(clip['task_id'], video_url, clip['start_time'], clip['duration'], output=output)
+                return
+        
+        windows = merge_clip_ranges(clips)
+        for window in windows:
+            keyframe = prior_keyframe(batch_id, media, window['clips'][0]['start_time'])
+            if keyframe is not None:
+                window['start'] = keyframe
+        print(f"Пакет {batch_id}: {len(clips)} клипов, {len(windows)} окон скачивания")
+        task_store.update(batch_id, {'windows': len(windows), 'status': 'Обработка пакета...'})
+        
+        with ThreadPoolExecutor(max_workers=ENCODE_CONCURRENCY) as pool:
+            for index, window in enumerate(windows):
+                window['path'] = SCRATCH_DIR / f"{batch_id}_window{index}.mp4"
+                for clip in window['clips']:
+                    update_progress(clip['task_id'], 20, 'Скачивание общего фрагмента...', 30)
+                with download_slots:
+                    with supervisor.stage(batch_id, 'download'):
+                        returncode = fetch_range(batch_id, media, window['start'], window['end'], window['path'])
+                if returncode != 0:
+                    metrics.count_error('download')
+                    for clip in window['clips']:
+                        fail_clip(clip['task_id'], 'Ошибка скачивания фрагмента')
+                    continue
+                # Параметры видео одинаковы для всех окон - ffprobe нужен не больше одного раза
+                if video is None:
+                    video = probe_video_stream(batch_id, {'input': window['path'], 'headers': {}})
+                window['video'] = video
+                for clip in window['clips']:
+                    update_progress(clip['task_id'], 60, 'Скачивание завершено (100%)', 100)
+                    pool.submit(encode_batch_clip, clip, window, video_url, output)
+        
+        task_store.update(batch_id, {'status': 'Пакет обработан'})
+        
+    except TaskCancelled as e:
+        print(f"Пакет {batch_id} остановлен: {e.status}")
+        metrics.count_error('timeout' if e.reason == 'timeout' else 'cancelled')
+        task_store.update(batch_id, {'status': e.status})
+        for clip in clips:
+            state = get_task_state(clip['task_id'])
+            if state is not None and state.get('progress', 0) < 100 and not state.get('error'):
+                set_task_state(clip['task_id'], cancelled_state(e.status))
+    except Exception as e:
+        print(f"Ошибка в пакетной задаче: {str(e)}")
+        metrics.count_error('internal')
+        if not is_direct_video_url(video_url):
+            metadata_cache.invalidate(video_url)
+        for clip in clips:
+            state = get_task_state(clip['task_id'])
+            if state is not None and state.get('progress', 0) < 100:
+                fail_clip(clip['task_id'], f'Ошибка: {str(e)}')
+    finally:
+        supervisor.forget(batch_id)
+        for window in windows:
+            if 'path' in window:
+                storage.discard(window['path'])
+        for owner in pinned:
+            storage.unpin(owner)
 
 @app.route('/progress/<task_id>')
 def get_progress(task_id):
-    if task_id in progress_store:
-        return jsonify(progress_store[task_id])
+    state = task_snapshot(task_id)
+    if state is not None:
+        return jsonify(state)
     return jsonify({'progress': 0, 'status': 'Неизвестная задача', 'download_percent': 0})
 
+@app.route('/batch/<batch_id>')
+def batch_progress(batch_id):
+    """Сводный прогресс пакета: средний прогресс, счётчики и состояние каждого клипа"""
+    batch = get_task_state(batch_id)
+    if batch is None or not batch.get('batch'):
+        return jsonify({'error': 'Неизвестный пакет'}), 404
+    
+    clips = []
+    for clip in batch['clips']:
+        state = task_snapshot(clip['gif_id'])
+        if state is None:
+            # Состояние удаляется при скачивании результата и при ошибке обработки
+            done = find_result(clip['gif_id'])[0] is not None
+            state = {'progress': 100, 'status': 'Готово'} if done else {'progress': 0, 'status': 'Ошибка обработки', 'error': True}
+        clips.append(dict(state, **clip))
+    
+    completed = sum(1 for clip in clips if clip.get('progress', 0) >= 100 and not clip.get('error'))
+    failed = sum(1 for clip in clips if clip.get('error'))
+    # Клипы с ошибкой считаются завершёнными, чтобы общий прогресс доходил до 100
+    progress = round(sum(100 if clip.get('error') else clip.get('progress', 0) for clip in clips) / len(clips))
+    
+    return jsonify({
+        'batch_id': batch_id,
+        'progress': progress,
+        'status': batch.get('status'),
+        'total': len(clips),
+        'completed': completed,
+        'failed': failed,
+        'finished': completed + failed == len(clips),
+        'queue_position': job_queue.position(batch_id),
+        'clips': clips
+    })
+
+def format_sse(event, data, event_id=None):
+    """Сообщение в формате text/event-stream"""
+    message = f'event: {event}\n'
+    if event_id is not None:
+        message += f'id: {event_id}\n'
+    return message + f'data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+@app.route('/progress/<task_id>/stream')
+def stream_progress(task_id):
+    """Server-Sent Events: событие отправляется только при изменении состояния задачи.
+    
+    id события - версия состояния; после переподключения браузер присылает
+    Last-Event-ID, и поток продолжается без повтора уже полученного состояния.
+    Финальные события: done (со ссылками на результат) или failed.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_version = int(last_event_id)
+    except (TypeError, ValueError):
+        last_version = None
+    
+    def events():
+        yield 'retry: 2000\n\n'
+        sent_marker = (last_version, None)
+        while True:
+            generation = task_store.generation()
+            state = task_snapshot(task_id)
+            if state is None:
+                yield format_sse('failed', {'progress': 0, 'status': 'Неизвестная задача', 'download_percent': 0, 'error': True})
+                return
+            
+            marker = (state['version'], state.get('queue_position'))
+            if marker != sent_marker:
+                sent_marker = marker
+                if state.get('error'):
+                    yield format_sse('failed', state, state['version'])
+                    return
+                if state.get('progress', 0) >= 100:
+                    yield format_sse('done', state, state['version'])
+                    return
+                yield format_sse('progress', state, state['version'])
+            
+            if not task_store.wait(generation, SSE_HEARTBEAT):
+                yield ': heartbeat\n\n'
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Счётчики попаданий и промахов кэша результатов и кэша метаданных yt-dlp"""
+    return jsonify(dict(result_cache.stats(), metadata=metadata_cache.stats(), storage=storage.stats()))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в формате Prometheus (по текущему процессу)"""
+    cache = result_cache.stats()
+    usage = storage.stats()
+    gauges = {
+        'videogif_queue_depth': ('Tasks waiting in the job queue', len(job_queue)),
+        'videogif_active_tasks': ('Tasks being processed by the worker pool', job_queue.active),
+        'videogif_temp_dir_bytes': ('Bytes used by files in the temp directory', temp_dir_bytes()),
+        'videogif_result_cache_hits': ('Result cache hits since start', cache['hits']),
+        'videogif_result_cache_misses': ('Result cache misses since start', cache['misses']),
+        'videogif_result_cache_bytes': ('Bytes held by the result cache', cache['bytes']),
+        'videogif_scratch_bytes': ('Bytes of intermediate files in the scratch area', usage['bytes']['scratch']),
+        'videogif_results_bytes': ('Bytes of task results in the results area', usage['bytes']['results']),
+        'videogif_storage_evictions': ('Tasks evicted to respect the storage quota', usage['evictions']),
+    }
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+def find_result(task_id):
+    """Файл результата задачи в любом из выходных форматов: (путь, описание формата) или (None, None)"""
+    for spec in OUTPUT_FORMATS.values():
+        result_path = TEMP_DIR / f"{task_id}{spec['ext']}"
+        if result_path.exists():
+            return result_path, spec
+    return None, None
+
+def find_outputs(task_id):
+    """Существующие файлы результатов задачи (анимация и превью)"""
+    return [path for path in (TEMP_DIR / f"{task_id}{suffix}" for suffix in ResultCache.RESULT_EXTENSIONS) if path.exists()]
+
+def serve_result(task_id, result_path, mimetype, download_name):
+    """Отдача файла результата с Range, ETag и условными запросами.
+    
+    Состояние задачи при скачивании не удаляется: повторный и докачивающий
+    запросы (и запросы CDN) получают тот же файл до /cleanup или истечения TTL.
+    В режиме RESULT_OFFLOAD байты отдаёт фронт-прокси, он же обрабатывает Range и ETag.
+    """
+    storage.touch(task_id)
+    if RESULT_OFFLOAD in ('x-accel', 'x-sendfile'):
+        response = Response(mimetype=mimetype)
+        if RESULT_OFFLOAD == 'x-accel':
+            response.headers['X-Accel-Redirect'] = RESULT_ACCEL_PREFIX.rstrip('/') + '/' + result_path.name
+        else:
+            response.headers['X-Sendfile'] = str(result_path.resolve())
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        response.cache_control.public = True
+        response.cache_control.max_age = RESULT_MAX_AGE
+    else:
+        # Валидаторы от id задачи, размера и inode: файл результата после записи не
+        # меняется, а повтор из кэша (жёсткая ссылка) получает свой id
+        stat = result_path.stat()
+        response = send_file(result_path, mimetype=mimetype, as_attachment=True, download_name=download_name,
+                             conditional=True, etag=f"{task_id}-{stat.st_size}-{stat.st_ino}",
+                             last_modified=stat.st_mtime, max_age=RESULT_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/download/<gif_id>')
 def download_gif(gif_id):
-    gif_path = TEMP_DIR / f"{gif_id}.gif"
-    if not gif_path.exists():
+    result_path, spec = find_result(gif_id)
+    if result_path is None:
         return "GIF не найден", 404
-    if gif_id in progress_store:
-        del progress_store[gif_id]
-    return send_file(gif_path, as_attachment=True, download_name='video.gif')
+    return serve_result(gif_id, result_path, spec['mimetype'], f"video{spec['ext']}")
+
+def dequeue_job(task_id):
+    """Снятие ещё не начатой задачи с очереди вместе с её арендой"""
+    if not job_queue.remove(task_id):
+        return False
+    task_store.finish_job(task_id)
+    with owned_jobs_lock:
+        owned_jobs.discard(task_id)
+    return True
+
+def stop_task(task_id):
+    """Снятие с очереди или остановка процессов задачи. True, если задача ещё не начиналась.
+    
+    Задачу может выполнять другой процесс: отметка cancel_requested в общем
+    хранилище останавливает её там в течение секунды (Supervisor.poll_requests).
+    """
+    if dequeue_job(task_id):
+        return True
+    state = get_task_state(task_id)
+    if state is not None and not state.get('error') and state.get('progress', 0) < 100 and not state.get('attached_to'):
+        task_store.update(task_id, {'cancel_requested': True})
+        supervisor.cancel(task_id)
+    return False
+
+def cancel_task(task_id):
+    """Отмена задачи запроса; общая с другими запросами конвертация продолжается"""
+    for victim in inflight_jobs.release(task_id):
+        state = get_task_state(victim)
+        if state is None or state.get('error') or state.get('progress', 0) >= 100:
+            continue
+        # У снятой с очереди, присоединённой и ожидающей в пакете задачи нет своего обработчика
+        if stop_task(victim) or state.get('attached_to') or state.get('batch_id'):
+            set_task_state(victim, cancelled_state('Отменено пользователем'))
+
+@app.route('/cancel/<gif_id>', methods=['POST'])
+def cancel(gif_id):
+    """Отмена задачи: из очереди снимается сразу, у выполняющейся убиваются процессы ffmpeg/yt-dlp"""
+    state = get_task_state(gif_id)
+    if state is None:
+        return jsonify({'error': 'Неизвестная задача'}), 404
+    if state.get('batch'):
+        for clip in state['clips']:
+            cancel_task(clip['gif_id'])
+        stop_task(gif_id)
+        task_store.update(gif_id, {'status': 'Отменено пользователем', 'queued': None})
+    else:
+        cancel_task(gif_id)
+    return jsonify({'success': True})
+
+def cleanup_task_files(task_id):
+    """Остановка задачи, удаление её файлов и состояния"""
+    stop_task(task_id)
+    storage.remove_task(task_id)
+    drop_task(task_id)
 
 @app.route('/cleanup/<gif_id>', methods=['POST'])
 def cleanup(gif_id):
-    for f in TEMP_DIR.glob(f"{gif_id}*"):
-        f.unlink(missing_ok=True)
-    if gif_id in progress_store:
-        del progress_store[gif_id]
+    state = get_task_state(gif_id)
+    # Очистка пакета удаляет и все его клипы
+    if state is not None and state.get('batch'):
+        for clip in state['clips']:
+            cleanup_task_files(clip['gif_id'])
+    # Файлы конвертации, к которой присоединены другие запросы, удаляются после её завершения
+    for task_id in inflight_jobs.release(gif_id):
+        cleanup_task_files(task_id)
     return jsonify({'success': True})
 
 @app.route('/download_image/<gif_id>')
@@ -447,17 +3183,15 @@ def download_image(gif_id):
         if not image_path.exists():
             return "Изображение не найдено", 404
     
-    if gif_id in progress_store:
-        del progress_store[gif_id]
-    
-    return send_file(image_path, as_attachment=True, download_name='video_frame.jpg')
+    mimetype = 'image/jpeg' if image_path.suffix == '.jpg' else 'image/png'
+    return serve_result(gif_id, image_path, mimetype, 'video_frame.jpg')
 
 def schedule_cleanup():
     """Функция для периодической очистки устаревших файлов"""
     while True:
         try:
             cleanup_old_files()
-            time.sleep(TEMP_FILE_TTL)  # Ожидаем TTL перед следующей очисткой
+            time.sleep(STORAGE_SWEEP_INTERVAL)
         except Exception as e:
             print(f"Ошибка при очистке файлов: {e}")
 
@@ -465,5 +3199,11 @@ def schedule_cleanup():
 cleanup_thread = threading.Thread(target=schedule_cleanup, daemon=True)
 cleanup_thread.start()
 
+# Запуск пула обработчиков
+for _ in range(JOB_WORKERS):
+    threading.Thread(target=job_worker, daemon=True).start()
+threading.Thread(target=lease_keeper, daemon=True).start()
+threading.Thread(target=supervisor.run, daemon=True).start()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0', port=5500)
@@ -0,0 +1,334 @@
+"""Сквозной бенчмарк: /convert -> /progress -> /download на локальных фикстурах.
+
+Запуск из корня проекта (Linux, нужны ffmpeg и зависимости приложения):
+
+    python -m benchmarks.e2e --requests 20 --concurrency 4 --json e2e.json
+    python -m benchmarks.e2e --fixtures 360p_h264_10s,720p_vp9_30s --requests 10
+    python -m benchmarks.e2e --app-url http://127.0.0.1:5500 --app-pid 12345
+
+Фикстуры (benchmarks.fixtures) раздаёт локальный HTTP-сервер, так что сеть не
+нужна: прямые ссылки .mp4/.webm/.m3u8 идут через is_direct_video_url, а
+HTML-страницы - через generic-экстрактор yt-dlp. Без --app-url приложение
+запускается отдельным процессом с пустым каталогом TEMP_DIR и выключенным кэшем
+результатов (включается флагом --cache).
+
+Отчёт: пропускная способность, p50/p95/p99 по стадиям (из spans задачи и
+замеров клиента), пиковый RSS приложения вместе с дочерними ffmpeg и CPU
+на один GIF. Результаты сохраняются в JSON для сравнения запусков.
+"""
+import argparse
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks.fixtures import DEFAULT_FIXTURES, build_fixtures, fixture_length
+from benchmarks.server import serve_directory
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+POLL_INTERVAL = 0.1
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def http_json(url, payload=None, timeout=30):
+    """GET или POST с JSON; возвращает (код ответа, тело)"""
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read() or b'{}')
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+def percentiles(values):
+    """p50/p95/p99 методом ближайшего ранга"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+
+    def rank(q):
+        return ordered[min(len(ordered), max(1, math.ceil(q * len(ordered)))) - 1]
+    return {
+        'count': len(ordered),
+        'p50': rank(0.50),
+        'p95': rank(0.95),
+        'p99': rank(0.99),
+        'max': ordered[-1],
+    }
+
+
+def process_tree(root_pid):
+    """PID процесса и всех его потомков по /proc"""
+    children = {}
+    for entry in Path('/proc').iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / 'stat').read_text()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def rss_bytes(pid):
+    try:
+        for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def cpu_seconds(pid):
+    """CPU процесса и уже завершённых (ожидавшихся) дочерних процессов"""
+    fields = Path(f'/proc/{pid}/stat').read_text().rsplit(')', 1)[1].split()
+    utime, stime, cutime, cstime = (int(value) for value in fields[11:15])
+    return (utime + stime + cutime + cstime) / CLOCK_TICKS
+
+
+class RssSampler(threading.Thread):
+    """Пиковый суммарный RSS приложения и его дочерних процессов"""
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_total = 0
+        self.peak_app = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            app_rss = rss_bytes(self.pid)
+            total = app_rss + sum(rss_bytes(pid) for pid in process_tree(self.pid)[1:])
+            self.peak_app = max(self.peak_app, app_rss)
+            self.peak_total = max(self.peak_total, total)
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(work_dir, use_cache, extra_env):
+    """Приложение в отдельном процессе; возвращает (process, base_url)"""
+    port = free_port()
+    env = dict(os.environ, VIDEOGIF_TEMP_DIR=str(work_dir / 'temp'), **extra_env)
+    if not use_cache:
+        env['VIDEOGIF_CACHE_BYTES'] = '0'
+    process = subprocess.Popen(
+        [sys.executable, '-c', f'from app import app; app.run(host="127.0.0.1", port={port}, threaded=True)'],
+        cwd=PROJECT_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'{base_url}/metrics', timeout=1).read()
+            return process, base_url
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('Приложение завершилось при запуске')
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('Приложение не ответило за 30 секунд')
+
+
+def run_request(app_url, job, timeout):
+    """convert -> progress -> download -> cleanup для одного клипа"""
+    result = {'fixture': job['fixture'], 'ok': False, 'timings': {}}
+    started = time.perf_counter()
+    status, body = http_json(f'{app_url}/convert', {
+        'video_url': job['url'], 'start_time': job['start_time'], 'duration': job['duration'],
+        'output_format': job['output_format'],
+    })
+    result['timings']['convert_request'] = time.perf_counter() - started
+    if status != 200 or not body.get('success'):
+        result['error'] = body.get('error', f'HTTP {status}')
+        return result
+    task_id = body['gif_id']
+
+    # spans берутся из последнего ответа /progress, когда задача готова
+    state = {}
+    while time.perf_counter() - started < timeout:
+        _, state = http_json(f'{app_url}/progress/{task_id}')
+        if state.get('error') or state.get('progress', 0) >= 100:
+            break
+        time.sleep(POLL_INTERVAL)
+    result['timings']['ready'] = time.perf_counter() - started
+    if state.get('error') or state.get('progress', 0) < 100:
+        result['error'] = state.get('status', 'timeout')
+        http_json(f'{app_url}/cleanup/{task_id}', {})
+        return result
+
+    for span in state.get('spans') or []:
+        result['timings'][span['stage']] = result['timings'].get(span['stage'], 0) + span['wall_seconds']
+    result['ffmpeg_cpu_seconds'] = sum(span['cpu_seconds'] for span in state.get('spans') or [])
+
+    download_started = time.perf_counter()
+    with urllib.request.urlopen(f'{app_url}/download/{task_id}', timeout=timeout) as response:
+        result['output_bytes'] = len(response.read())
+    result['timings']['download'] = time.perf_counter() - download_started
+    result['timings']['end_to_end'] = time.perf_counter() - started
+    http_json(f'{app_url}/cleanup/{task_id}', {})
+    result['ok'] = True
+    return result
+
+
+def build_jobs(fixtures, base_url, count, duration, output_format):
+    """Задания по кругу фикстур; начало клипа сдвигается, чтобы запросы не совпадали"""
+    names = list(fixtures)
+    jobs = []
+    for index in range(count):
+        name = names[index % len(names)]
+        span = max(1, fixture_length(name) - duration - 2)
+        jobs.append({
+            'fixture': name,
+            'url': f'{base_url}/{fixtures[name]}',
+            'start_time': 1 + (index // len(names) * 2) % span,
+            'duration': duration,
+            'output_format': output_format,
+        })
+    return jobs
+
+
+def summarize(results, wall_seconds, app_cpu, sampler):
+    completed = [result for result in results if result['ok']]
+    stages = {}
+    for result in completed:
+        for stage, seconds in result['timings'].items():
+            stages.setdefault(stage, []).append(seconds)
+    by_fixture = {}
+    for result in results:
+        row = by_fixture.setdefault(result['fixture'], {'completed': 0, 'failed': 0, 'errors': []})
+        if result['ok']:
+            row['completed'] += 1
+        else:
+            row['failed'] += 1
+            row['errors'].append(result.get('error'))
+    return {
+        'requests': len(results),
+        'completed': len(completed),
+        'failed': len(results) - len(completed),
+        'wall_seconds': wall_seconds,
+        'throughput_per_minute': len(completed) / wall_seconds * 60 if wall_seconds else 0,
+        'stages': {stage: percentiles(values) for stage, values in sorted(stages.items())},
+        'peak_rss_bytes': sampler.peak_total if sampler else None,
+        'app_peak_rss_bytes': sampler.peak_app if sampler else None,
+        'cpu_seconds_per_gif': app_cpu / len(completed) if app_cpu is not None and completed else None,
+        'ffmpeg_cpu_seconds_per_gif': (
+            sum(result['ffmpeg_cpu_seconds'] for result in completed) / len(completed) if completed else None
+        ),
+        'output_bytes_mean': sum(result['output_bytes'] for result in completed) / len(completed) if completed else None,
+        'by_fixture': by_fixture,
+    }
+
+
+def print_report(report):
+    print(f"Готово {report['completed']}/{report['requests']} за {report['wall_seconds']:.1f} с, "
+          f"{report['throughput_per_minute']:.1f} GIF/мин")
+    print(f"{'стадия':<16} {'n':>5} {'p50, с':>9} {'p95, с':>9} {'p99, с':>9}")
+    for stage, row in report['stages'].items():
+        print(f"{stage:<16} {row['count']:>5} {row['p50']:>9.3f} {row['p95']:>9.3f} {row['p99']:>9.3f}")
+    if report['peak_rss_bytes'] is not None:
+        print(f"Пиковый RSS: {report['peak_rss_bytes'] / 2**20:.0f} МБ "
+              f"(процесс приложения {report['app_peak_rss_bytes'] / 2**20:.0f} МБ)")
+    if report['cpu_seconds_per_gif'] is not None:
+        print(f"CPU на GIF: {report['cpu_seconds_per_gif']:.2f} с (ffmpeg {report['ffmpeg_cpu_seconds_per_gif']:.2f} с)")
+    for name, row in report['by_fixture'].items():
+        if row['failed']:
+            print(f"Ошибки {name}: {row['failed']} ({row['errors'][0]})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', default=','.join(DEFAULT_FIXTURES), help='имена фикстур через запятую')
+    parser.add_argument('--fixtures-dir', type=Path, help='каталог фикстур (по умолчанию временный)')
+    parser.add_argument('--requests', type=int, default=12, help='число конвертаций')
+    parser.add_argument('--concurrency', type=int, default=4, help='одновременных клиентов')
+    parser.add_argument('--duration', type=int, default=3, help='длительность клипа, сек')
+    parser.add_argument('--output-format', default='gif', help='формат результата')
+    parser.add_argument('--timeout', type=float, default=300, help='предельное время одной конвертации, сек')
+    parser.add_argument('--cache', action='store_true', help='не выключать кэш результатов приложения')
+    parser.add_argument('--env', action='append', default=[], help='переменная окружения приложения, KEY=VALUE')
+    parser.add_argument('--app-url', help='использовать уже запущенное приложение')
+    parser.add_argument('--app-pid', type=int, help='PID запущенного приложения для замера RSS и CPU')
+    parser.add_argument('--json', type=Path, help='сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        fixtures_dir = args.fixtures_dir or work_dir / 'fixtures'
+        print('Подготовка фикстур...')
+        fixtures = build_fixtures(fixtures_dir, args.fixtures.split(','))
+        server, media_url = serve_directory(fixtures_dir)
+
+        app_process = None
+        app_env = dict(item.split('=', 1) for item in args.env)
+        try:
+            if args.app_url:
+                app_url, app_pid = args.app_url.rstrip('/'), args.app_pid
+            else:
+                app_process, app_url = start_app(work_dir, args.cache, app_env)
+                app_pid = app_process.pid
+
+            jobs = build_jobs(fixtures, media_url, args.requests, args.duration, args.output_format)
+            sampler = RssSampler(app_pid) if app_pid else None
+            cpu_before = cpu_seconds(app_pid) if app_pid else None
+            if sampler:
+                sampler.start()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                results = list(pool.map(lambda job: run_request(app_url, job, args.timeout), jobs))
+            wall_seconds = time.perf_counter() - started
+            app_cpu = cpu_seconds(app_pid) - cpu_before if app_pid else None
+            if sampler:
+                sampler.stop()
+        finally:
+            if app_process is not None:
+                app_process.terminate()
+                app_process.wait(timeout=10)
+            server.shutdown()
+
+    report = summarize(results, wall_seconds, app_cpu, sampler)
+    report['config'] = {
+        'fixtures': list(fixtures),
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'output_format': args.output_format,
+        'cache': args.cache,
+        'env': app_env,
+        'cpu_count': os.cpu_count(),
+    }
+    print_report(report)
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
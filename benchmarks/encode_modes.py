@@ -0,0 +1,88 @@
+"""Сравнение режимов кодирования GIF: один запуск ffmpeg против двухпроходного.
+
+Запуск из корня проекта:
+
+    python -m benchmarks.encode_modes --runs 5
+    python -m benchmarks.encode_modes --input clip.mp4 --duration 5 --json result.json
+
+Для каждого режима измеряется время выполнения (wall) и процессорное время
+дочерних процессов ffmpeg (user + sys).
+"""
+import argparse
+import json
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from app import build_single_pass_command, build_two_pass_commands
+from benchmarks.fixtures import generate_clip
+
+
+def children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_mode(mode, video_path, seek_time, duration, work_dir):
+    """Один прогон режима; возвращает (wall, cpu, размер GIF)"""
+    gif_path = work_dir / f'{mode}.gif'
+    image_path = work_dir / f'{mode}.jpg'
+    if mode == 'single':
+        commands = [build_single_pass_command(video_path, seek_time, duration, gif_path, image_path)]
+    else:
+        commands = build_two_pass_commands(
+            video_path, seek_time, duration, gif_path, image_path, work_dir / f'{mode}_palette.png'
+        )
+    
+    cpu_before = children_cpu_seconds()
+    wall_before = time.perf_counter()
+    for cmd in commands:
+        subprocess.run(cmd, check=True, capture_output=True)
+    wall = time.perf_counter() - wall_before
+    cpu = children_cpu_seconds() - cpu_before
+    return wall, cpu, gif_path.stat().st_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', type=Path, help='исходное видео (по умолчанию генерируется testsrc2 720p)')
+    parser.add_argument('--seek', type=float, default=2, help='смещение начала GIF, сек')
+    parser.add_argument('--duration', type=int, default=3, help='длительность GIF, сек')
+    parser.add_argument('--runs', type=int, default=3, help='число прогонов каждого режима')
+    parser.add_argument('--json', type=Path, help='сохранить результаты в JSON')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        video_path = args.input
+        if video_path is None:
+            video_path = work_dir / 'source.mp4'
+            generate_clip(video_path)
+        
+        results = {}
+        for mode in ('two_pass', 'single'):
+            samples = [run_mode(mode, video_path, args.seek, args.duration, work_dir) for _ in range(args.runs)]
+            walls, cpus, sizes = zip(*samples)
+            results[mode] = {
+                'wall_median': statistics.median(walls),
+                'wall_min': min(walls),
+                'cpu_median': statistics.median(cpus),
+                'gif_bytes': sizes[-1],
+                'runs': args.runs,
+            }
+    
+    print(f"{'режим':<10} {'wall, с':>10} {'min, с':>10} {'CPU, с':>10} {'GIF, байт':>12}")
+    for mode, row in results.items():
+        print(f"{mode:<10} {row['wall_median']:>10.3f} {row['wall_min']:>10.3f} {row['cpu_median']:>10.3f} {row['gif_bytes']:>12}")
+    speedup = results['two_pass']['wall_median'] / results['single']['wall_median']
+    print(f"Ускорение single относительно two_pass: x{speedup:.2f}")
+    
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
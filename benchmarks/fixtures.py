@@ -0,0 +1,119 @@
+"""Генерируемые тестовые видео для бенчмарков.
+
+Все ролики собираются ffmpeg из генератора testsrc2 с фиксированными
+параметрами, поэтому результаты разных запусков сравнимы. Уже созданные
+файлы повторно не генерируются.
+
+    python -m benchmarks.fixtures --dir /tmp/videogif-fixtures
+
+Виды фикстур:
+
+    mp4/webm  прямая ссылка на файл (путь is_direct_video_url)
+    hls       плейлист .m3u8 с сегментами MPEG-TS
+    page      HTML-страница с тегом <video>: ссылку разбирает generic-экстрактор yt-dlp
+"""
+import argparse
+import subprocess
+from pathlib import Path
+
+FIXTURES = {
+    '360p_h264_10s': {'width': 640, 'height': 360, 'length': 10, 'codec': 'libx264', 'container': 'mp4'},
+    '720p_h264_30s': {'width': 1280, 'height': 720, 'length': 30, 'codec': 'libx264', 'container': 'mp4'},
+    '1080p_h264_60s': {'width': 1920, 'height': 1080, 'length': 60, 'codec': 'libx264', 'container': 'mp4'},
+    '720p_vp9_30s': {'width': 1280, 'height': 720, 'length': 30, 'codec': 'libvpx-vp9', 'container': 'webm'},
+    '720p_hls_30s': {'width': 1280, 'height': 720, 'length': 30, 'codec': 'libx264', 'container': 'hls'},
+    'page_720p_h264': {'page_of': '720p_h264_30s'},
+}
+
+DEFAULT_FIXTURES = ('720p_h264_30s', '720p_hls_30s', 'page_720p_h264')
+
+CODEC_ARGS = {
+    'libx264': ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p'],
+    'libvpx-vp9': ['-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8', '-b:v', '2M'],
+}
+
+
+def generate_clip(path, width=1280, height=720, fps=30, length=8, gop=None, codec='libx264'):
+    """Тестовый ролик из генератора testsrc2; gop - интервал ключевых кадров в кадрах"""
+    gop_args = ['-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0'] if gop else []
+    container_args = ['-movflags', '+faststart'] if Path(path).suffix == '.mp4' else []
+    subprocess.run([
+        'ffmpeg', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={fps}',
+        '-t', str(length),
+        *CODEC_ARGS[codec],
+        *gop_args,
+        *container_args,
+        str(path)
+    ], check=True, capture_output=True)
+
+
+def generate_hls(directory, width=1280, height=720, fps=30, length=30, segment_seconds=4):
+    """HLS-плейлист index.m3u8 с сегментами по segment_seconds, каждый начинается с ключевого кадра"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    gop = fps * segment_seconds
+    subprocess.run([
+        'ffmpeg', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={fps}',
+        '-t', str(length),
+        *CODEC_ARGS['libx264'],
+        '-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0',
+        '-f', 'hls', '-hls_time', str(segment_seconds), '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', str(directory / 'segment%03d.ts'),
+        str(directory / 'index.m3u8')
+    ], check=True, capture_output=True)
+
+
+def write_page(path, video_url, title):
+    """HTML-страница с видео для generic-экстрактора yt-dlp"""
+    Path(path).write_text(
+        f'<!DOCTYPE html>\n<html><head><title>{title}</title></head>\n'
+        f'<body><video controls src="{video_url}"></video></body></html>\n'
+    )
+
+
+def build_fixture(directory, name):
+    """Создание фикстуры (если её ещё нет); возвращает путь относительно directory"""
+    directory = Path(directory)
+    spec = FIXTURES[name]
+    if 'page_of' in spec:
+        video = build_fixture(directory, spec['page_of'])
+        relative = f'pages/{name}.html'
+        (directory / 'pages').mkdir(parents=True, exist_ok=True)
+        write_page(directory / relative, f'/{video}', name)
+        return relative
+    if spec['container'] == 'hls':
+        relative = f'{name}/index.m3u8'
+        if not (directory / relative).exists():
+            generate_hls(directory / name, spec['width'], spec['height'], length=spec['length'])
+        return relative
+    relative = f"{name}.{spec['container']}"
+    if not (directory / relative).exists():
+        generate_clip(directory / relative, spec['width'], spec['height'], length=spec['length'], codec=spec['codec'])
+    return relative
+
+
+def fixture_length(name):
+    """Длительность ролика фикстуры, сек"""
+    spec = FIXTURES[name]
+    return FIXTURES[spec['page_of']]['length'] if 'page_of' in spec else spec['length']
+
+
+def build_fixtures(directory, names=DEFAULT_FIXTURES):
+    """Создание набора фикстур: {имя: путь относительно directory}"""
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    return {name: build_fixture(directory, name) for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', type=Path, required=True, help='каталог фикстур')
+    parser.add_argument('--fixtures', default=','.join(FIXTURES), help='имена фикстур через запятую')
+    args = parser.parse_args()
+    for name, relative in build_fixtures(args.dir, args.fixtures.split(',')).items():
+        print(f'{name:<16} {args.dir / relative}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Сравнение способов скачивания сегмента: фиксированный запас против поиска по ключевым кадрам.
+
+Запуск из корня проекта:
+
+    python -m benchmarks.seeking --runs 3
+    python -m benchmarks.seeking --gop 240 --start 37 --duration 3 --json seeking.json
+    python -m benchmarks.seeking --sources hls
+
+Исходный ролик раздаётся локальным HTTP-сервером с поддержкой Range, поэтому
+ffmpeg читает его так же, как прямую ссылку CDN. Источники: mp4 (один файл,
+чтение по индексу moov) и hls (плейлист MPEG-TS, временные метки которого
+начинаются не с нуля). Режимы:
+
+    padded_reencode  запас -2/+4 с с перекодированием на границах
+                     (как yt-dlp с force_keyframes_at_cuts)
+    padded           запас -2/+4 с, копирование потоков (прежний fetch_segment)
+    keyframe         ffprobe индекса ключевых кадров и скачивание от ближайшего
+                     предшествующего ключевого кадра, копирование потоков
+
+Для каждого режима измеряются байты, отданные сервером (вместе с ffprobe),
+время скачивания и time-to-first-frame: скачивание плюс декодирование первого
+кадра GIF из сегмента. clip_seconds - сколько секунд клипа реально есть в
+сегменте после смещения seek (меньше duration - сегмент начался не там).
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from app import build_fetch_command, nearest_keyframe, probe_keyframes, segment_range
+from benchmarks.fixtures import generate_clip, generate_hls
+from benchmarks.server import RangeRequestHandler, serve_directory
+
+
+def reencode_command(media, range_start, range_end, video_path):
+    """Сегмент с перекодированием, как при force_keyframes_at_cuts"""
+    return [
+        'ffmpeg', '-ss', str(range_start), '-to', str(range_end), '-i', media['input'],
+        '-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'copy', str(video_path), '-y'
+    ]
+
+
+def first_frame_seconds(video_path, seek):
+    """Время до первого декодированного кадра GIF в сегменте"""
+    started = time.perf_counter()
+    subprocess.run([
+        'ffmpeg', '-ss', str(seek), '-i', str(video_path), '-frames:v', '1', '-f', 'null', '-'
+    ], check=True, capture_output=True)
+    return time.perf_counter() - started
+
+
+def media_seconds(video_path):
+    """Длительность скачанного сегмента по данным ffprobe"""
+    result = subprocess.run([
+        'ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', str(video_path)
+    ], check=True, capture_output=True, text=True)
+    return float(result.stdout.strip())
+
+
+def run_mode(mode, media, start_time, duration, work_dir):
+    """Один прогон режима; возвращает словарь с байтами, временем и размером сегмента"""
+    video_path = work_dir / f'{mode}.mp4'
+    RangeRequestHandler.reset_counter()
+    started = time.perf_counter()
+
+    keyframe = None
+    if mode == 'keyframe':
+        probed = probe_keyframes(media, start_time)
+        keyframe = nearest_keyframe(probed[1], start_time) if probed else None
+    range_start, range_end = segment_range(start_time, duration, keyframe)
+    build = reencode_command if mode == 'padded_reencode' else build_fetch_command
+    subprocess.run(build(media, range_start, range_end, video_path), check=True, capture_output=True)
+
+    fetch_seconds = time.perf_counter() - started
+    seek = start_time - range_start
+    first_frame = first_frame_seconds(video_path, seek)
+    return {
+        'bytes_fetched': RangeRequestHandler.bytes_sent,
+        'fetch_seconds': fetch_seconds,
+        'ttff_seconds': fetch_seconds + first_frame,
+        'segment_bytes': video_path.stat().st_size,
+        'segment_seconds': range_end - range_start,
+        'clip_seconds': min(duration, media_seconds(video_path) - seek),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', type=Path, help='исходное видео вместо генерируемого mp4 (testsrc2 720p)')
+    parser.add_argument('--sources', default='mp4,hls', help='источники через запятую: mp4, hls')
+    parser.add_argument('--gop', type=int, default=120, help='интервал ключевых кадров генерируемого ролика, кадров')
+    parser.add_argument('--start', type=float, default=31, help='начало клипа, сек')
+    parser.add_argument('--duration', type=int, default=3, help='длительность клипа, сек')
+    parser.add_argument('--runs', type=int, default=3, help='число прогонов каждого режима')
+    parser.add_argument('--json', type=Path, help='сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        sources = {}
+        for kind in args.sources.split(','):
+            if kind == 'mp4':
+                source = work_dir / ('source' + (args.input.suffix if args.input else '.mp4'))
+                if args.input is None:
+                    generate_clip(source, length=60, gop=args.gop)
+                else:
+                    source.symlink_to(args.input.resolve())
+            else:
+                source = work_dir / 'hls' / 'index.m3u8'
+                generate_hls(source.parent, length=60, segment_seconds=max(1, args.gop // 30))
+            sources[kind] = source
+        server, base_url = serve_directory(work_dir)
+
+        results = {}
+        try:
+            for kind, source in sources.items():
+                media = {'input': f'{base_url}/{source.relative_to(work_dir).as_posix()}', 'headers': {}}
+                for mode in ('padded_reencode', 'padded', 'keyframe'):
+                    samples = [run_mode(mode, media, args.start, args.duration, work_dir) for _ in range(args.runs)]
+                    results.setdefault(kind, {})[mode] = {
+                        'bytes_fetched': statistics.median(s['bytes_fetched'] for s in samples),
+                        'fetch_median': statistics.median(s['fetch_seconds'] for s in samples),
+                        'ttff_median': statistics.median(s['ttff_seconds'] for s in samples),
+                        'segment_bytes': samples[-1]['segment_bytes'],
+                        'segment_seconds': samples[-1]['segment_seconds'],
+                        'clip_seconds': samples[-1]['clip_seconds'],
+                        'runs': args.runs,
+                    }
+        finally:
+            server.shutdown()
+
+    for kind, modes in results.items():
+        print(f"\n{kind}")
+        print(f"{'режим':<16} {'байт сети':>12} {'скачивание, с':>14} {'TTFF, с':>10} {'сегмент, с':>11} {'клип, с':>8}")
+        for mode, row in modes.items():
+            print(f"{mode:<16} {row['bytes_fetched']:>12.0f} {row['fetch_median']:>14.3f} "
+                  f"{row['ttff_median']:>10.3f} {row['segment_seconds']:>11.2f} {row['clip_seconds']:>8.2f}")
+        saved = 1 - modes['keyframe']['bytes_fetched'] / max(1, modes['padded']['bytes_fetched'])
+        print(f"keyframe скачивает на {saved:.0%} меньше байт, чем padded")
+
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
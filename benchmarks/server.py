@@ -0,0 +1,76 @@
+"""Локальный HTTP-сервер для фикстур: одиночные Range-запросы и подсчёт отданных байт.
+
+Поддержка Range нужна, чтобы ffmpeg и ffprobe читали файлы так же, как
+прямые ссылки CDN (поиск по moov, скачивание диапазонов).
+"""
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Раздача файлов с поддержкой одиночного Range и подсчётом отданных байт"""
+
+    bytes_sent = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return None
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            first, _, last = range_header[6:].split(',')[0].partition('-')
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+            end = min(end, size - 1)
+            if start > end:
+                self.send_error(416)
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(str(path)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        source = path.open('rb')
+        source.seek(start)
+        self._remaining = end - start + 1
+        return source
+
+    def copyfile(self, source, outputfile):
+        while self._remaining > 0:
+            chunk = source.read(min(64 * 1024, self._remaining))
+            if not chunk:
+                break
+            try:
+                outputfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                break
+            self._remaining -= len(chunk)
+            with self.lock:
+                RangeRequestHandler.bytes_sent += len(chunk)
+
+    @classmethod
+    def reset_counter(cls):
+        with cls.lock:
+            cls.bytes_sent = 0
+
+
+def serve_directory(directory, host='127.0.0.1', port=0):
+    """HTTP-сервер каталога в фоновом потоке; возвращает (server, base_url)"""
+    server = ThreadingHTTPServer((host, port), partial(RangeRequestHandler, directory=str(directory)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
@@ -0,0 +1,85 @@
+"""Постановка конвертаций и пакетов: кэш результатов, данные VK, проверка клипов, перегрузка (/convert)"""
+import uuid
+
+import pytest
+
+import app
+from app import InflightJobs, ResultCache
+
+VIDEO_URL = 'https://vk.com/video-1_2'
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'TEMP_DIR', tmp_path)
+    monkeypatch.setitem(app.storage.areas, 'results', tmp_path)
+    monkeypatch.setattr(app, 'result_cache', ResultCache(tmp_path / 'cache', 10 * 1024 * 1024))
+    monkeypatch.setattr(app, 'inflight_jobs', InflightJobs())
+    queued = []
+    monkeypatch.setattr(app, 'enqueue_conversion', lambda task_id, *args: queued.append((task_id, args)) or len(queued))
+    client = app.app.test_client()
+    client.queued = queued
+    return client
+
+
+def cache_result(start_time, duration):
+    task_id = str(uuid.uuid4())
+    (app.TEMP_DIR / f'{task_id}.gif').write_bytes(b'GIF89a')
+    app.result_cache.store(app.result_cache.key_for(VIDEO_URL, start_time, duration, app.DEFAULT_OUTPUT), task_id)
+
+
+def test_anonymous_request_served_from_cache(client):
+    cache_result(10, 3)
+
+    response = client.post('/convert', json={'video_url': VIDEO_URL, 'start_time': 10, 'duration': 3})
+    assert response.get_json()['cached'] is True
+    assert client.queued == []
+
+
+def test_vk_credentials_bypass_cache(client):
+    cache_result(10, 3)
+
+    response = client.post('/convert', json={'video_url': VIDEO_URL, 'start_time': 10, 'duration': 3,
+                                             'vk_username': 'user', 'vk_password': 'secret'})
+    assert 'cached' not in response.get_json()
+    assert len(client.queued) == 1
+
+
+def test_vk_credentials_do_not_coalesce(client):
+    anonymous = {'video_url': VIDEO_URL, 'start_time': 20, 'duration': 3}
+    private = dict(anonymous, vk_username='user', vk_password='secret')
+
+    client.post('/convert', json=private)
+    assert 'attached' not in client.post('/convert', json=anonymous).get_json()
+    assert 'attached' not in client.post('/convert', json=private).get_json()
+    assert client.post('/convert', json=anonymous).get_json()['attached'] is True
+    assert len(client.queued) == 3
+
+
+@pytest.mark.parametrize('clip', [5, None, {'start_time': 'abc'}, {'duration': [3]}])
+def test_batch_rejects_invalid_clip(client, clip):
+    response = client.post('/convert/batch', json={'video_url': VIDEO_URL, 'clips': [{'start_time': 1}, clip]})
+    assert response.status_code == 400
+    assert 'Клип 2' in response.get_json()['error']
+
+
+def test_batch_cached_clips_and_overload(client, monkeypatch):
+    cache_result(30, 3)
+    monkeypatch.setattr(app, 'enqueue_batch', lambda *args: None)
+
+    response = client.post('/convert/batch', json={'video_url': VIDEO_URL, 'clips': [{'start_time': 30}, {'start_time': 40}]})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '10'
+
+    response = client.post('/convert/batch', json={'video_url': VIDEO_URL, 'clips': [{'start_time': 30}]})
+    clip = response.get_json()['clips'][0]
+    assert clip['cached'] is True
+    assert app.get_task_state(clip['gif_id'])['cached'] is True
+
+
+def test_overload_response(client, monkeypatch):
+    monkeypatch.setattr(app, 'enqueue_conversion', lambda *args: None)
+
+    response = client.post('/convert', json={'video_url': VIDEO_URL, 'start_time': 50, 'duration': 3})
+    assert response.status_code == 503
+    assert response.get_json()['error'] == 'Сервер перегружен, попробуйте позже'
@@ -0,0 +1,43 @@
+"""Отдача результата: стабильный ETag, условные запросы и докачка (serve_result)"""
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def result(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'TEMP_DIR', tmp_path)
+    monkeypatch.setattr(app, 'RESULT_OFFLOAD', '')
+    monkeypatch.setitem(app.storage.areas, 'results', tmp_path)
+    task_id = str(uuid.uuid4())
+    (tmp_path / f'{task_id}.gif').write_bytes(b'GIF89a' + bytes(range(256)))
+    return task_id
+
+
+def test_etag_is_stable_between_downloads(result):
+    client = app.app.test_client()
+    first = client.get(f'/download/{result}')
+    second = client.get(f'/download/{result}')
+
+    assert first.status_code == 200
+    assert first.headers['ETag'] == second.headers['ETag']
+    assert first.headers['Last-Modified'] == second.headers['Last-Modified']
+
+
+def test_if_none_match_returns_304(result):
+    client = app.app.test_client()
+    etag = client.get(f'/download/{result}').headers['ETag']
+
+    response = client.get(f'/download/{result}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+
+def test_range_with_if_range_returns_206(result):
+    client = app.app.test_client()
+    etag = client.get(f'/download/{result}').headers['ETag']
+
+    response = client.get(f'/download/{result}', headers={'Range': 'bytes=100-', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.data == (b'GIF89a' + bytes(range(256)))[100:]
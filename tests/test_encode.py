@@ -0,0 +1,42 @@
+"""Запись параметров кодирования в состояние задачи (encode_video_segment)"""
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def two_pass(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'TEMP_DIR', tmp_path)
+    monkeypatch.setattr(app, 'SCRATCH_DIR', tmp_path)
+    monkeypatch.setattr(app, 'GIF_ENCODE_MODE', 'two_pass')
+    monkeypatch.setattr(app, 'GIF_OPTIMIZE', False)
+    monkeypatch.setattr(app, 'storage', app.StorageManager({'scratch': tmp_path, 'results': tmp_path}, 10 ** 9, 0))
+
+    def run_ffmpeg(cmd, span=None, on_line=None):
+        app.Path(cmd[-2]).write_bytes(b'data')
+        return 0, ''
+
+    def run_ffmpeg_with_progress(unique_id, cmd, *args):
+        app.Path(cmd[-2]).write_bytes(b'GIF89a')
+        return 0
+
+    monkeypatch.setattr(app, 'run_ffmpeg', run_ffmpeg)
+    monkeypatch.setattr(app, 'run_ffmpeg_with_progress', run_ffmpeg_with_progress)
+    return tmp_path
+
+
+def test_two_pass_records_standard_profile(two_pass):
+    task_id = str(uuid.uuid4())
+    app.set_task_state(task_id, {'progress': 70, 'status': 'Обработка видео...'})
+    source = {'input': two_pass / f'{task_id}_segment.mp4', 'headers': {}, 'seek': 2, 'streamed': False,
+              'video': {'width': 1280, 'height': 720, 'fps': 30.0}}
+
+    assert app.encode_video_segment(task_id, source, 3) is True
+
+    encode = app.get_task_state(task_id)['encode']
+    assert encode['profile'] == 'standard'
+    assert (encode['format'], encode['width'], encode['fps'], encode['bytes']) == ('gif', 640, 20, 6)
+    assert encode['degraded'] is False
+    assert app.result_cacheable(task_id)
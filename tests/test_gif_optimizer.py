@@ -0,0 +1,96 @@
+"""Оптимизатор GIF: ключ кэша, отчёт о недоступности и перепаковка кадров"""
+import time
+import uuid
+
+import pytest
+
+import app
+
+
+def test_optimizer_settings_change_gif_cache_key(monkeypatch):
+    gif = dict(app.DEFAULT_OUTPUT, format='gif')
+    webp = dict(app.DEFAULT_OUTPUT, format='webp')
+    monkeypatch.setattr(app, 'GIF_OPTIMIZE', False)
+    plain = app.result_cache.key_for('https://example.com/a.mp4', 10, 3, gif)
+    plain_webp = app.result_cache.key_for('https://example.com/a.mp4', 10, 3, webp)
+
+    monkeypatch.setattr(app, 'GIF_OPTIMIZE', True)
+    monkeypatch.setattr(app, 'gif_optimizer_available', lambda: True)
+    optimized = app.result_cache.key_for('https://example.com/a.mp4', 10, 3, gif)
+    monkeypatch.setattr(app, 'GIF_FRAME_TOLERANCE', app.GIF_FRAME_TOLERANCE + 1)
+    tolerant = app.result_cache.key_for('https://example.com/a.mp4', 10, 3, gif)
+
+    assert len({plain, optimized, tolerant}) == 3
+    assert app.result_cache.key_for('https://example.com/a.mp4', 10, 3, webp) == plain_webp
+
+
+def test_missing_dependencies_reported(monkeypatch, tmp_path):
+    task_id = str(uuid.uuid4())
+    app.set_task_state(task_id, {'progress': 95, 'status': 'Конвертация...'})
+    monkeypatch.setattr(app, 'GIF_OPTIMIZE', True)
+    monkeypatch.setattr(app, 'gif_optimizer_available', lambda: False)
+
+    assert app.optimize_gif(task_id, tmp_path / f'{task_id}.gif', 96) is None
+    assert app.get_task_state(task_id)['optimize'] == {'status': 'unavailable'}
+
+
+def test_duplicate_frames_merged_and_rendering_kept(tmp_path):
+    np = pytest.importorskip('numpy')
+    Image = pytest.importorskip('PIL.Image')
+    from PIL import ImageSequence
+
+    background = np.random.default_rng(0).integers(0, 255, (60, 80, 3), dtype=np.uint8)
+    frames = []
+    for index in range(6):
+        frame = background.copy()
+        frame[20:30, (index // 2) * 10:(index // 2) * 10 + 10] = (255, 0, 0)
+        if index % 2:
+            frame[0, 0] = frame[0, 0] // 2  # один пиксель: почти повтор
+        frames.append(Image.fromarray(frame))
+    palette = frames[0].quantize(255, dither=Image.Dither.NONE)
+    frames = [frame.quantize(palette=palette, dither=Image.Dither.NONE) for frame in frames]
+    source = tmp_path / 'source.gif'
+    frames[0].save(source, save_all=True, append_images=frames[1:], duration=50, loop=0)
+
+    data, frames_in, frames_out = app.build_optimized_gif(source, time.monotonic() + 10)
+    result = tmp_path / 'result.gif'
+    result.write_bytes(data)
+
+    assert (frames_in, frames_out) == (6, 3)
+    rendered = [(np.asarray(frame.convert('RGB')).copy(), frame.info['duration'])
+                for frame in ImageSequence.Iterator(Image.open(result))]
+    assert [duration for _, duration in rendered] == [100, 100, 100]
+    expected = [np.asarray(frame.convert('RGB')) for frame in ImageSequence.Iterator(Image.open(source))][::2]
+    for (actual, _), wanted in zip(rendered, expected):
+        assert np.array_equal(actual, wanted)
+
+
+def test_budget_exceeded_returns_none(tmp_path):
+    pytest.importorskip('numpy')
+    Image = pytest.importorskip('PIL.Image')
+
+    source = tmp_path / 'source.gif'
+    Image.new('P', (8, 8)).save(source)
+    assert app.build_optimized_gif(source, time.monotonic() - 1) is None
+
+
+def test_thresholds_read_at_call_time(tmp_path, monkeypatch):
+    pytest.importorskip('numpy')
+    Image = pytest.importorskip('PIL.Image')
+
+    frames = [Image.new('RGB', (8, 8), color).quantize(4) for color in ((0, 0, 0), (200, 200, 200))]
+    source = tmp_path / 'source.gif'
+    frames[0].save(source, save_all=True, append_images=frames[1:], duration=50, loop=0)
+
+    assert app.build_optimized_gif(source, time.monotonic() + 10)[1:] == (2, 2)
+    monkeypatch.setattr(app, 'GIF_FRAME_TOLERANCE', 255)
+    assert app.build_optimized_gif(source, time.monotonic() + 10)[1:] == (2, 1)
+
+
+def test_skipped_optimization_not_cacheable():
+    task_id = str(uuid.uuid4())
+    app.set_task_state(task_id, {'progress': 100, 'optimize': {'status': 'not_smaller'}})
+    assert app.result_cacheable(task_id) is True
+
+    app.task_store.update(task_id, {'optimize': {'status': 'skipped'}})
+    assert app.result_cacheable(task_id) is False
@@ -0,0 +1,73 @@
+"""Учёт одинаковых конвертаций в работе (InflightJobs)"""
+from app import InflightJobs
+
+
+def test_first_request_becomes_primary():
+    jobs = InflightJobs()
+    assert jobs.attach('key', 'a') is None
+    assert jobs.attach('key', 'b') == 'a'
+    assert len(jobs) == 1
+
+
+def test_primary_release_with_followers_keeps_job_until_finish():
+    jobs = InflightJobs()
+    jobs.attach('key', 'a')
+    jobs.attach('key', 'b')
+
+    # Файлы ведущей задачи ещё нужны присоединённой
+    assert jobs.release('a') == []
+    assert jobs.attach('key', 'c') == 'a'
+
+    followers, released = jobs.finish('a')
+    assert followers == ['b', 'c']
+    assert released is True
+    assert len(jobs) == 0
+    # Следующий такой же запрос начинает новую конвертацию
+    assert jobs.attach('key', 'd') is None
+
+
+def test_follower_release():
+    jobs = InflightJobs()
+    jobs.attach('key', 'a')
+    jobs.attach('key', 'b')
+
+    assert jobs.release('b') == ['b']
+    assert jobs.finish('a') == ([], False)
+    assert len(jobs) == 0
+
+
+def test_last_follower_release_after_primary_release_removes_both():
+    jobs = InflightJobs()
+    jobs.attach('key', 'a')
+    jobs.attach('key', 'b')
+
+    assert jobs.release('a') == []
+    assert jobs.release('b') == ['b', 'a']
+    assert len(jobs) == 0
+    assert jobs.finish('a') == ([], False)
+    assert jobs.attach('key', 'c') is None
+
+
+def test_primary_release_without_followers():
+    jobs = InflightJobs()
+    jobs.attach('key', 'a')
+
+    assert jobs.release('a') == ['a']
+    assert len(jobs) == 0
+    assert jobs.finish('a') == ([], False)
+
+
+def test_finish_after_follower_only_released():
+    jobs = InflightJobs()
+    jobs.attach('key', 'a')
+    jobs.attach('key', 'b')
+    jobs.attach('key', 'c')
+
+    jobs.release('c')
+    assert jobs.finish('a') == (['b'], False)
+    # Присоединённая задача после завершения освобождается как обычная
+    assert jobs.release('b') == ['b']
+
+
+def test_unknown_task_release():
+    assert InflightJobs().release('missing') == ['missing']
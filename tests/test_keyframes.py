@@ -0,0 +1,41 @@
+"""Поиск ключевых кадров с учётом start_time контейнера (MPEG-TS/HLS)"""
+import app
+
+
+def fake_ffprobe(start_time, packets):
+    calls = []
+
+    def run_ffprobe(media, *args):
+        calls.append(args)
+        if 'format=start_time' in args:
+            return f'{start_time}\n'
+        return ''.join(f'{pts},{flags}\n' for pts, flags in packets)
+
+    return run_ffprobe, calls
+
+
+def test_keyframes_are_relative_to_container_start(monkeypatch):
+    # HLS от ffmpeg: метки начинаются с 1.4 с, ключевые кадры каждые 4 с
+    run_ffprobe, calls = fake_ffprobe(1.4, [(25.4, 'K__'), (26.4, '___'), (29.4, 'K__'), (30.4, '___')])
+    monkeypatch.setattr(app, 'run_ffprobe', run_ffprobe)
+
+    interval, keyframes = app.probe_keyframes({'input': 'http://example/index.m3u8', 'headers': {}}, 31)
+
+    assert interval == (21, 31)
+    assert keyframes == [24.0, 28.0]
+    read_intervals = calls[1][calls[1].index('-read_intervals') + 1]
+    assert read_intervals == f'{1.4 + 21}%{1.4 + 31}'
+    assert app.segment_range(31, 3, app.nearest_keyframe(keyframes, 31)) == (28.0, 35)
+
+
+def test_zero_start_time(monkeypatch):
+    run_ffprobe, _ = fake_ffprobe(0.0, [(24.0, 'K_'), (28.0, 'K_')])
+    monkeypatch.setattr(app, 'run_ffprobe', run_ffprobe)
+
+    assert app.probe_keyframes({'input': 'http://example/a.mp4', 'headers': {}}, 31) == ((21, 31), [24.0, 28.0])
+
+
+def test_probe_failure(monkeypatch):
+    monkeypatch.setattr(app, 'run_ffprobe', lambda media, *args: None)
+
+    assert app.probe_keyframes({'input': 'http://example/a.mp4', 'headers': {}}, 31) is None
@@ -0,0 +1,55 @@
+"""Счётчики попаданий и промахов кэша результатов (ResultCache)"""
+import uuid
+
+import app
+from app import ResultCache
+
+
+def make_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'TEMP_DIR', tmp_path)
+    return ResultCache(tmp_path / 'cache', 10 * 1024 * 1024)
+
+
+def test_miss_counted_on_lookup_even_without_store(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch)
+
+    assert cache.restore('key', str(uuid.uuid4())) is False
+    assert cache.restore('key', str(uuid.uuid4())) is False
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_store_then_hit(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch)
+    task_id, repeat_id = str(uuid.uuid4()), str(uuid.uuid4())
+
+    assert cache.restore('key', task_id) is False
+    (tmp_path / f'{task_id}.gif').write_bytes(b'GIF89a')
+    cache.store('key', task_id)
+    assert cache.restore('key', repeat_id) is True
+    assert (tmp_path / f'{repeat_id}.gif').read_bytes() == b'GIF89a'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_recheck_hit_replaces_first_miss(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch)
+    task_id, repeat_id = str(uuid.uuid4()), str(uuid.uuid4())
+    (tmp_path / f'{task_id}.gif').write_bytes(b'GIF89a')
+    cache.store('canonical', task_id)
+
+    assert cache.restore('by-url', repeat_id) is False
+    assert cache.restore('missing', repeat_id, recheck=True) is False
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert cache.restore('canonical', repeat_id, recheck=True) is True
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_restore_keeps_cached_file_mtime(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch)
+    task_id, repeat_id = str(uuid.uuid4()), str(uuid.uuid4())
+    (tmp_path / f'{task_id}.gif').write_bytes(b'GIF89a')
+    cache.store('key', task_id)
+    mtime = (tmp_path / f'{task_id}.gif').stat().st_mtime
+
+    assert cache.restore('key', repeat_id) is True
+    assert (tmp_path / f'{repeat_id}.gif').stat().st_mtime == mtime
+    assert (tmp_path / 'cache' / f'key{ResultCache.USED_SUFFIX}').exists()
@@ -0,0 +1,73 @@
+"""Общее хранилище состояния задач в SQLite (SQLiteStateBackend)"""
+import threading
+import time
+
+import pytest
+
+from app import SQLiteStateBackend, create_state_backend
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return SQLiteStateBackend(tmp_path / 'state.db')
+
+
+def test_url_keeps_absolute_path(tmp_path):
+    path = tmp_path / 'nested' / 'state.db'
+    path.parent.mkdir()
+
+    backend = create_state_backend(f'sqlite://{path}')
+
+    assert backend.path == str(path)
+    assert path.exists()
+
+
+def test_unknown_url():
+    with pytest.raises(ValueError):
+        create_state_backend('redis://localhost/0')
+
+
+def test_put_update_version(backend):
+    backend.put('task', {'progress': 0, 'status': 'В очереди'})
+    assert backend.get('task') == {'progress': 0, 'status': 'В очереди', 'version': 1}
+
+    assert backend.update('task', {'progress': 50, 'status': None}) is True
+    assert backend.get('task') == {'progress': 50, 'version': 2}
+    # Без изменений версия не растёт
+    assert backend.update('task', {'progress': 50}) is False
+    assert backend.get('task')['version'] == 2
+    assert backend.update('missing', {'progress': 1}) is False
+
+    backend.put('task', {'progress': 100})
+    assert backend.get('task') == {'progress': 100, 'version': 3}
+    backend.delete('task')
+    assert backend.get('task') is None
+
+
+def test_claim_expired_job(backend):
+    backend.add_job('live', {'url': 'a'}, 'owner-1', 60)
+    backend.add_job('dead', {'url': 'b'}, 'owner-2', -1)
+
+    assert backend.claim_expired_job('owner-3', 60) == ('dead', {'url': 'b'})
+    # Захваченная задача получила новую аренду
+    assert backend.claim_expired_job('owner-4', 60) is None
+
+    backend.renew_leases(['live'], 'owner-1', -1)
+    assert backend.claim_expired_job('owner-4', 60) == ('live', {'url': 'a'})
+    backend.finish_job('live')
+    backend.renew_leases(['live'], 'owner-4', -1)
+    assert backend.claim_expired_job('owner-5', 60) is None
+
+
+def test_wait_wakes_on_change_from_other_connection(tmp_path, backend):
+    other = SQLiteStateBackend(tmp_path / 'state.db')
+    generation = backend.generation()
+    assert backend.wait(generation, 0.05) is False
+
+    timer = threading.Timer(0.1, other.put, ('task', {'progress': 1}))
+    timer.start()
+    started = time.time()
+    assert backend.wait(generation, 5) is True
+    assert time.time() - started < 2
+    timer.join()
+    assert backend.generation() != generation
@@ -0,0 +1,87 @@
+"""Учёт и вытеснение файлов задач (StorageManager)"""
+import os
+import time
+import uuid
+
+import pytest
+
+from app import StorageFull, StorageManager
+
+
+@pytest.fixture
+def areas(tmp_path):
+    return {'scratch': tmp_path / 'scratch', 'results': tmp_path / 'results'}
+
+
+def write(path, size):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'x' * size)
+    return path
+
+
+def test_quota_evicts_least_recently_used(areas):
+    evicted = []
+    storage = StorageManager(areas, 250, 0, evicted.append)
+    old, new = str(uuid.uuid4()), str(uuid.uuid4())
+    storage.track(write(areas['results'] / f'{old}.gif', 150))
+    storage.track(write(areas['results'] / f'{new}.gif', 150))
+
+    assert evicted == [old]
+    assert not (areas['results'] / f'{old}.gif').exists()
+    assert storage.total_bytes() == 150
+
+
+def test_pinned_writer_gets_storage_full(areas):
+    storage = StorageManager(areas, 100, 0)
+    task_id = str(uuid.uuid4())
+    storage.pin(task_id)
+    with pytest.raises(StorageFull):
+        storage.track(write(areas['scratch'] / f'{task_id}_segment.mp4', 200))
+    assert (areas['scratch'] / f'{task_id}_segment.mp4').exists()
+
+
+def test_files_of_other_processes_are_not_evicted(areas):
+    foreign = write(areas['results'] / f'{uuid.uuid4()}.gif', 500)
+    storage = StorageManager(areas, 100, 0)
+    task_id = str(uuid.uuid4())
+    storage.track(write(areas['results'] / f'{task_id}.gif', 50))
+
+    assert foreign.exists()
+    assert storage.total_bytes() == 50
+
+
+def test_sweep_removes_old_orphans_only(areas):
+    orphan = write(areas['scratch'] / f'{uuid.uuid4()}_segment.mp4', 10)
+    os.utime(orphan, (time.time() - 7200, time.time() - 7200))
+    fresh = write(areas['results'] / f'{uuid.uuid4()}.gif', 10)
+    unrelated = write(areas['results'] / 'state.db', 10)
+    os.utime(unrelated, (time.time() - 7200, time.time() - 7200))
+
+    StorageManager(areas, 1000, 0).sweep(3600)
+
+    assert not orphan.exists()
+    assert fresh.exists()
+    assert unrelated.exists()
+
+
+def test_sweep_forgets_files_deleted_elsewhere(areas):
+    storage = StorageManager(areas, 1000, 0)
+    path = write(areas['results'] / f'{uuid.uuid4()}.gif', 100)
+    storage.track(path)
+    path.unlink()
+
+    storage.sweep(3600)
+    assert storage.total_bytes() == 0
+
+
+def test_touch_keeps_result_mtime_and_protects_from_sweep(areas):
+    task_id = str(uuid.uuid4())
+    result = write(areas['results'] / f'{task_id}.gif', 10)
+    old = time.time() - 7200
+    os.utime(result, (old, old))
+
+    StorageManager(areas, 1000, 0).touch(task_id)
+    StorageManager(areas, 1000, 0).sweep(3600)
+
+    assert result.exists()
+    assert result.stat().st_mtime == old
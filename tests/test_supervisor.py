@@ -0,0 +1,45 @@
+"""Отмена задач через общее хранилище состояния (Supervisor.poll_requests)"""
+import uuid
+
+import pytest
+
+from app import Supervisor, TaskCancelled, set_task_state, stop_task, task_store
+
+
+def start_stage(supervisor, task_id):
+    stage = supervisor.stage(task_id, 'encode')
+    stage.__enter__()
+    return stage
+
+
+def test_cancel_requested_by_other_process_stops_task():
+    supervisor = Supervisor()
+    task_id = str(uuid.uuid4())
+    set_task_state(task_id, {'progress': 50, 'status': 'Конвертация...'})
+    start_stage(supervisor, task_id)
+
+    supervisor.poll_requests()
+    supervisor.check(task_id)
+
+    task_store.update(task_id, {'cancel_requested': True})
+    supervisor.poll_requests()
+    with pytest.raises(TaskCancelled):
+        supervisor.check(task_id)
+
+
+def test_deleted_state_stops_task():
+    supervisor = Supervisor()
+    task_id = str(uuid.uuid4())
+    start_stage(supervisor, task_id)
+
+    supervisor.poll_requests()
+    with pytest.raises(TaskCancelled):
+        supervisor.check(task_id)
+
+
+def test_stop_task_records_cancel_request_for_unowned_job():
+    task_id = str(uuid.uuid4())
+    set_task_state(task_id, {'progress': 30, 'status': 'Скачивание...'})
+
+    assert stop_task(task_id) is False
+    assert task_store.get(task_id)['cancel_requested'] is True
@@ -0,0 +1,14 @@
+"""Параметры yt-dlp для скачивания сегмента (build_ydl_opts)"""
+import yt_dlp
+from yt_dlp.downloader.external import FFmpegFD
+
+import app
+
+
+def test_ffmpeg_downloader_gets_read_timeout():
+    opts = app.build_ydl_opts('task', 'https://example.com/watch?v=1', 10, 3)
+    ydl = yt_dlp.YoutubeDL(dict(opts, quiet=True))
+    downloader = FFmpegFD(ydl, ydl.params)
+
+    # Те же ключи, по которым FFmpegFD добавляет аргументы перед -i
+    assert downloader._configuration_args(('_i1', '_i')) == ['-rw_timeout', str(app.YTDLP_SOCKET_TIMEOUT * 1000000)]